@@ -1,24 +1,137 @@
 from motor.motor_asyncio import AsyncIOMotorClient
 from pydantic_settings import BaseSettings
+from pymongo import monitoring
 from dotenv import load_dotenv
+from typing import Optional
+import threading
 import os
 
 class Settings(BaseSettings):
 
     load_dotenv()
 
-    DB_USER: str = os.getenv("DB_USER")
-    DB_PASSWORD: str = os.getenv("DB_PASSWORD")
-    DB_CLUSTER: str = os.getenv("DB_CLUSTER")
+    DB_USER: Optional[str] = os.getenv("DB_USER")
+    DB_PASSWORD: Optional[str] = os.getenv("DB_PASSWORD")
+    DB_CLUSTER: Optional[str] = os.getenv("DB_CLUSTER")
     DB_NAME: str = os.getenv("DB_NAME")
 
+    # Full connection string, e.g. "mongodb://localhost:27017" for a local mongod.
+    # When set it takes precedence over the Atlas SRV URL built from the fields above.
+    DB_URL: Optional[str] = os.getenv("DB_URL")
+
+    # Connection pool and timeout tuning (see pymongo.MongoClient for semantics)
+    DB_MAX_POOL_SIZE: int = int(os.getenv("DB_MAX_POOL_SIZE", 100))
+    DB_MIN_POOL_SIZE: int = int(os.getenv("DB_MIN_POOL_SIZE", 0))
+    DB_MAX_IDLE_TIME_MS: Optional[int] = os.getenv("DB_MAX_IDLE_TIME_MS")
+    DB_CONNECT_TIMEOUT_MS: int = int(os.getenv("DB_CONNECT_TIMEOUT_MS", 20000))
+    DB_SOCKET_TIMEOUT_MS: Optional[int] = os.getenv("DB_SOCKET_TIMEOUT_MS")
+    DB_SERVER_SELECTION_TIMEOUT_MS: int = int(os.getenv("DB_SERVER_SELECTION_TIMEOUT_MS", 30000))
+    DB_WAIT_QUEUE_TIMEOUT_MS: Optional[int] = os.getenv("DB_WAIT_QUEUE_TIMEOUT_MS")
+    DB_COMPRESSORS: Optional[str] = os.getenv("DB_COMPRESSORS")  # e.g. "zstd,zlib"
+    DB_READ_PREFERENCE: str = os.getenv("DB_READ_PREFERENCE", "primary")
+
+    # /ready reports the node as degraded above these thresholds
+    READY_MAX_LATENCY_MS: float = float(os.getenv("READY_MAX_LATENCY_MS", 500))
+    READY_MAX_POOL_UTILIZATION: float = float(os.getenv("READY_MAX_POOL_UTILIZATION", 0.9))
+
     @property
     def MONGODB_URL(self):
+        if self.DB_URL:
+            return self.DB_URL
         return f"mongodb+srv://{self.DB_USER}:{self.DB_PASSWORD}@{self.DB_CLUSTER}.mongodb.net/?retryWrites=true&w=majority&appName=cul-cluster"
 
+    @property
+    def client_options(self) -> dict:
+        '''
+        Keyword arguments passed to the Mongo client. Optional settings that are not configured are left out
+        so that the driver (or the connection string) decides.
+        '''
+        options = {
+            "maxPoolSize": self.DB_MAX_POOL_SIZE,
+            "minPoolSize": self.DB_MIN_POOL_SIZE,
+            "connectTimeoutMS": self.DB_CONNECT_TIMEOUT_MS,
+            "serverSelectionTimeoutMS": self.DB_SERVER_SELECTION_TIMEOUT_MS,
+            "readPreference": self.DB_READ_PREFERENCE,
+            "maxIdleTimeMS": self.DB_MAX_IDLE_TIME_MS,
+            "socketTimeoutMS": self.DB_SOCKET_TIMEOUT_MS,
+            "waitQueueTimeoutMS": self.DB_WAIT_QUEUE_TIMEOUT_MS,
+            "compressors": self.DB_COMPRESSORS,
+        }
+        return {key: value for key, value in options.items() if value is not None}
+
+
+class PoolUsageListener(monitoring.ConnectionPoolListener):
+    '''
+    Tracks how many pooled connections are currently checked out so that /ready can report pool utilization.
+    The driver does not expose this number publicly, so it is derived from connection pool monitoring events.
+
+    maxPoolSize applies to each server's pool separately, so usage is kept per server address. Events can
+    arrive from driver threads, so the counters are only touched under a lock.
+    '''
+
+    def __init__(self):
+        self.checked_out = {}
+        self.open_connections = {}
+        self.checkout_failures = 0
+        self._lock = threading.Lock()
+
+    def _add(self, counters: dict, address, delta: int):
+        with self._lock:
+            counters[address] = max(0, counters.get(address, 0) + delta)
+
+    def connection_checked_out(self, event):
+        self._add(self.checked_out, event.address, 1)
+
+    def connection_checked_in(self, event):
+        self._add(self.checked_out, event.address, -1)
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkout_failures += 1
+
+    def connection_created(self, event):
+        self._add(self.open_connections, event.address, 1)
+
+    def connection_closed(self, event):
+        self._add(self.open_connections, event.address, -1)
+
+    def pool_closed(self, event):
+        with self._lock:
+            self.checked_out.pop(event.address, None)
+            self.open_connections.pop(event.address, None)
+
+    def pool_created(self, event): pass
+    def pool_ready(self, event): pass
+    def pool_cleared(self, event): pass
+    def connection_ready(self, event): pass
+    def connection_check_out_started(self, event): pass
+
+    def snapshot(self, max_pool_size: int) -> dict:
+        '''
+        Returns the pool usage of every known server and the utilization of the busiest one,
+        since a single saturated pool is enough to stall the requests routed to that server.
+        '''
+        with self._lock:
+            addresses = set(self.checked_out) | set(self.open_connections)
+            servers = {
+                f"{host}:{port}": {"in_use": self.checked_out.get((host, port), 0), "open": self.open_connections.get((host, port), 0)}
+                for host, port in sorted(addresses)
+            }
+            checkout_failures = self.checkout_failures
+
+        busiest = max((server["in_use"] for server in servers.values()), default=0)
+        return {
+            "servers": servers,
+            "max_size": max_pool_size,
+            "utilization": round(busiest / max_pool_size, 3) if max_pool_size else 0.0,
+            "checkout_failures": checkout_failures,
+        }
+
+
 settings = Settings()
+pool_listener = PoolUsageListener()
 
-client = AsyncIOMotorClient(settings.MONGODB_URL)
+client = AsyncIOMotorClient(settings.MONGODB_URL, event_listeners=[pool_listener], **settings.client_options)
 database = client[settings.DB_NAME]
 
 def get_database():
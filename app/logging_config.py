@@ -0,0 +1,228 @@
+'''
+This file sets up structured logging for the app. Records are emitted as one JSON object per line and carry the id of the
+request they were logged in. Loggers only put records on an in-memory queue, a listener thread formats and writes them,
+so logging never blocks the event loop on stdout.
+
+Configuration (environment variables):
+    LOG_LEVEL: The root log level, defaults to INFO.
+    LOG_LEVELS: Per-logger levels, e.g. "routers.normalize_line_endings=WARNING,routers.archive_utils=DEBUG".
+    LOG_SAMPLE_RATES: Fraction of DEBUG/INFO records kept per logger, e.g. "routers.normalize_line_endings=0.01".
+                      Warnings and errors are never sampled out.
+    LOG_QUEUE_SIZE: Maximum number of records waiting to be written, further records are dropped and counted.
+'''
+
+import os
+import sys
+import copy
+import json
+import time
+import uuid
+import queue
+import random
+import logging
+import contextvars
+from logging.handlers import QueueHandler, QueueListener
+
+request_id_var: contextvars.ContextVar = contextvars.ContextVar("request_id", default=None)
+
+# Attributes every LogRecord has, everything else was passed through `extra` and is added to the JSON output
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "request_id"}
+
+_listener = None
+_queue_handler = None
+
+
+def _parse_mapping(value: str) -> dict:
+    '''
+    Parses "name=value,name=value" into a dict.
+    '''
+    mapping = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            name, setting = item.split("=", 1)
+            mapping[name.strip()] = setting.strip()
+    return mapping
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class RequestContextFilter(logging.Filter):
+    '''
+    Adds the id of the current request to every record. Runs in the logging thread, before the record is queued.
+    '''
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    '''
+    Keeps only a fraction of the DEBUG and INFO records of the configured loggers (and their children).
+    '''
+
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.rates = rates
+        self.sampled_out = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+
+        name = record.name
+        while name:
+            if name in self.rates:
+                if random.random() < self.rates[name]:
+                    return True
+                self.sampled_out += 1
+                return False
+            name = name.rpartition(".")[0]
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    '''
+    A QueueHandler which drops records when the queue is full instead of blocking or reporting an error,
+    and which keeps the formatted exception separate from the message for the JSON formatter.
+    '''
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        record.stack_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging() -> None:
+    '''
+    Routes all logging through the queue and starts the listener thread writing JSON lines to stderr.
+    Calling it again has no effect.
+
+    Args:
+        None
+
+    Returns:
+        None
+
+    Raises:
+        None
+    '''
+    global _listener, _queue_handler
+    if _listener is not None:
+        return
+
+    log_queue = queue.Queue(maxsize=int(os.getenv("LOG_QUEUE_SIZE", 10000)))
+
+    _queue_handler = NonBlockingQueueHandler(log_queue)
+    _queue_handler.addFilter(RequestContextFilter())
+    _queue_handler.addFilter(SamplingFilter({name: float(rate) for name, rate in _parse_mapping(os.getenv("LOG_SAMPLE_RATES")).items()}))
+
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(JsonFormatter())
+
+    root = logging.getLogger()
+    root.handlers = [_queue_handler]
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    for name, level in _parse_mapping(os.getenv("LOG_LEVELS")).items():
+        logging.getLogger(name).setLevel(level.upper())
+
+    _listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+
+
+def stop_logging() -> None:
+    '''
+    Stops the listener thread after it has written all queued records.
+    '''
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def logging_stats() -> dict:
+    if _queue_handler is None:
+        return {}
+    sampling_filter = next(f for f in _queue_handler.filters if isinstance(f, SamplingFilter))
+    return {
+        "queued": _queue_handler.queue.qsize(),
+        "dropped": _queue_handler.dropped,
+        "sampled_out": sampling_filter.sampled_out,
+    }
+
+
+class RequestContextMiddleware:
+    '''
+    ASGI middleware assigning an id to every request (taken from the X-Request-ID header when present), returning it in
+    the X-Request-ID response header and logging the method, path, status and duration of the request when it completes.
+    '''
+
+    def __init__(self, app):
+        self.app = app
+        self.logger = logging.getLogger("requests")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")[:64]
+                break
+        request_id = request_id or uuid.uuid4().hex
+        token = request_id_var.set(request_id)
+
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            self.logger.info("request completed", extra={
+                "method": scope["method"],
+                "path": scope["path"],
+                "status_code": status_code,
+                "duration_ms": round((time.perf_counter() - start) * 1000, 2),
+            })
+            request_id_var.reset(token)
@@ -1,6 +1,7 @@
 import socket
 import os
 import uvicorn
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
 from fastapi.responses import StreamingResponse
 from starlette.responses import JSONResponse
@@ -8,9 +9,42 @@ from starlette.middleware.sessions import SessionMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 
+from logging_config import setup_logging, stop_logging, logging_stats, RequestContextMiddleware
 from routers import router as api_router
+from routers.metrics import register_metrics
+from routers.profiling import ProfilingMiddleware
+from routers.compression import CompressionMiddleware
+from routers.version_index import version_index
+from routers.search_index import search_index
+from routers.download_stats import download_stats
+from routers.integrity_scrubber import integrity_scrubber
+from routers.reverse_dependencies import reverse_dependency_index
+from routers.push_webhook import push_refresh_queue
+from routers.change_feed import start_change_feed
+from routers.module_trash import module_reaper
+from starlette.concurrency import run_in_threadpool
 
-app = FastAPI()
+setup_logging()
+register_metrics("logging", logging_stats)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await run_in_threadpool(version_index.load_all)
+    await run_in_threadpool(search_index.load_all)
+    await download_stats.start()
+    await reverse_dependency_index.start()
+    await start_change_feed()
+    await push_refresh_queue.start()
+    integrity_scrubber.start()
+    module_reaper.start()
+    yield
+    await module_reaper.stop()
+    await push_refresh_queue.stop()
+    await integrity_scrubber.stop()
+    await download_stats.stop()
+    stop_logging()
+
+app = FastAPI(lifespan=lifespan)
 
 # Mount static folder (e.g., CSS, JS, images)
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -26,7 +60,17 @@ app.add_middleware(
     max_age=60 * 60 * 24 * 15
 )
 
+# Compression of pages and JSON, inside the access logging so that its time is part of the request duration
+app.add_middleware(CompressionMiddleware)
+
+# Request ids and access logging
+app.add_middleware(RequestContextMiddleware)
+
+# Opt-in request profiling, added last so that it wraps the whole middleware stack
+app.add_middleware(ProfilingMiddleware)
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8000))
-    uvicorn.run("main:app", host="0.0.0.0", port=port)
+    # Uvicorn's own loggers go through the JSON logging set up above, requests are logged by RequestContextMiddleware
+    uvicorn.run("main:app", host="0.0.0.0", port=port, log_config=None, access_log=False)
     # uvicorn.run("main:app", host="127.0.0.1", port=port)
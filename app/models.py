@@ -15,4 +15,11 @@ class Module(BaseModel):
     module_id: int
     module_name: str
     module_url: str
-    associated_user: str
\ No newline at end of file
+    associated_user: str
+
+class ModuleVersionQuery(BaseModel):
+    module_name: str
+    current_version: Optional[str] = None
+
+class BatchVersionsRequest(BaseModel):
+    modules: list[ModuleVersionQuery]
@@ -7,9 +7,17 @@ from .serve_files_cli import router as serve_files_cli
 from .cli_funcs import router as cli_funcs
 from .webui_routes import router as webui_routes
 from .keep_alive import router as keep_alive
+from .metrics import router as metrics
+from .profiling import router as profiling
+from .push_webhook import router as push_webhook
+from .change_feed import router as change_feed
 
 router = APIRouter()
 router.include_router(serve_files_cli)
 router.include_router(cli_funcs)
 router.include_router(webui_routes)
-router.include_router(keep_alive)
\ No newline at end of file
+router.include_router(keep_alive)
+router.include_router(metrics)
+router.include_router(profiling)
+router.include_router(push_webhook)
+router.include_router(change_feed)
\ No newline at end of file
@@ -0,0 +1,222 @@
+'''
+This module provides admission control for expensive endpoints. Each route class (e.g. "archive" for zip downloads,
+"ingest" for cloning and hashing repositories) gets its own concurrency limit with a bounded wait queue, and every
+client gets a token bucket per route class. Requests over the limits are rejected with 429 (rate limited) or 503
+(overloaded) and a Retry-After header instead of piling up and starving cheap endpoints.
+
+Usage:
+    @router.get("/files/{module_name}", dependencies=[Depends(admission("archive"))])
+'''
+
+import asyncio
+import ipaddress
+import math
+import os
+import time
+from collections import OrderedDict
+from fastapi import HTTPException, Request
+from .metrics import register_metrics
+
+# Upper bound of tracked clients per route class, least recently seen clients are forgotten first
+MAX_TRACKED_CLIENTS = 10000
+
+# Reverse proxies whose X-Forwarded-For header is trusted, comma separated addresses or CIDR ranges
+TRUSTED_PROXIES = [
+    ipaddress.ip_network(entry.strip(), strict=False)
+    for entry in os.getenv("ADMISSION_TRUSTED_PROXIES", "").split(",") if entry.strip()
+]
+
+
+class TokenBucket:
+    '''
+    A token bucket which refills at `rate` tokens per second up to `burst` tokens.
+    '''
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def take(self) -> float:
+        '''
+        Takes one token from the bucket.
+
+        Returns:
+            float: 0 if a token was taken, otherwise the number of seconds until a token is available.
+        '''
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class RouteClassLimiter:
+    '''
+    Limits the number of concurrently running requests of a route class and the number of requests waiting for a slot.
+    Also keeps the per-client token buckets of the route class and the counters reported by /metrics.
+    '''
+
+    def __init__(self, name: str, max_concurrent: int, max_queue: int, queue_timeout: float, rate: float, burst: float):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.rate = rate
+        self.burst = burst
+
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._buckets: OrderedDict[str, TokenBucket] = OrderedDict()
+
+        self.active = 0
+        self.waiting = 0
+        self.avg_service_time = 1.0
+        self.admitted = 0
+        self.rate_limited = 0
+        self.shed_queue_full = 0
+        self.shed_timeout = 0
+
+    def retry_after(self) -> int:
+        '''
+        Estimates in how many seconds a slot is likely to be free, based on the average service time and the queue length.
+        '''
+        return max(1, math.ceil(self.avg_service_time * (self.waiting + 1) / self.max_concurrent))
+
+    def check_rate(self, client_id: str) -> None:
+        if self.rate <= 0:
+            return
+
+        bucket = self._buckets.get(client_id)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst)
+            self._buckets[client_id] = bucket
+            if len(self._buckets) > MAX_TRACKED_CLIENTS:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(client_id)
+
+        wait = bucket.take()
+        if wait:
+            self.rate_limited += 1
+            raise HTTPException(status_code=429, detail="Too many requests, please retry later.", headers={"Retry-After": str(math.ceil(wait))})
+
+    async def acquire(self) -> None:
+        if self._semaphore.locked() and self.waiting >= self.max_queue:
+            self.shed_queue_full += 1
+            raise HTTPException(status_code=503, detail="Server is busy, please retry later.", headers={"Retry-After": str(self.retry_after())})
+
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.shed_timeout += 1
+            raise HTTPException(status_code=503, detail="Server is busy, please retry later.", headers={"Retry-After": str(self.retry_after())})
+        finally:
+            self.waiting -= 1
+
+        self.active += 1
+        self.admitted += 1
+
+    def release(self, service_time: float) -> None:
+        self.active -= 1
+        # Exponentially weighted moving average, used for the Retry-After estimate
+        self.avg_service_time = 0.8 * self.avg_service_time + 0.2 * service_time
+        self._semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "avg_service_time_s": round(self.avg_service_time, 3),
+            "admitted": self.admitted,
+            "rate_limited": self.rate_limited,
+            "shed_queue_full": self.shed_queue_full,
+            "shed_timeout": self.shed_timeout,
+            "tracked_clients": len(self._buckets),
+        }
+
+
+def _limiter_from_env(name: str, max_concurrent: int, max_queue: int, queue_timeout: float, rate: float, burst: float) -> RouteClassLimiter:
+    '''
+    Creates the limiter of a route class, the defaults can be overridden with ADMISSION_<NAME>_<SETTING> environment variables.
+    '''
+    prefix = f"ADMISSION_{name.upper()}_"
+    return RouteClassLimiter(
+        name,
+        max_concurrent=int(os.getenv(prefix + "MAX_CONCURRENT", max_concurrent)),
+        max_queue=int(os.getenv(prefix + "MAX_QUEUE", max_queue)),
+        queue_timeout=float(os.getenv(prefix + "QUEUE_TIMEOUT", queue_timeout)),
+        rate=float(os.getenv(prefix + "RATE", rate)),
+        burst=float(os.getenv(prefix + "BURST", burst)),
+    )
+
+
+limiters = {
+    # Building zip archives of module versions
+    "archive": _limiter_from_env("archive", max_concurrent=4, max_queue=16, queue_timeout=10, rate=2, burst=10),
+    # Single files and small batches of files of a version, much cheaper than archives
+    "raw": _limiter_from_env("raw", max_concurrent=16, max_queue=64, queue_timeout=5, rate=20, burst=100),
+    # Cloning/pulling repositories and hashing their versions
+    "ingest": _limiter_from_env("ingest", max_concurrent=2, max_queue=4, queue_timeout=30, rate=0.1, burst=3),
+}
+
+register_metrics("admission", lambda: {name: limiter.stats() for name, limiter in limiters.items()})
+
+
+def _is_trusted_proxy(address: str) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in TRUSTED_PROXIES)
+
+
+def get_client_id(request: Request) -> str:
+    '''
+    Returns the address of the client. X-Forwarded-For is only honoured when the request comes from one of the
+    ADMISSION_TRUSTED_PROXIES, otherwise any client could pick a new rate limit bucket for every request.
+    The header is read from the right and the first address which is not a trusted proxy is the client.
+    '''
+    peer = request.client.host if request.client else "unknown"
+    if not _is_trusted_proxy(peer):
+        return peer
+
+    forwarded_for = [entry.strip() for entry in request.headers.get("x-forwarded-for", "").split(",") if entry.strip()]
+    for address in reversed(forwarded_for):
+        if not _is_trusted_proxy(address):
+            return address
+    return forwarded_for[0] if forwarded_for else peer
+
+
+def admission(route_class: str):
+    '''
+    Returns a dependency which applies the rate limit and concurrency limit of the given route class to an endpoint.
+    The concurrency slot is held until the endpoint returns.
+
+    Args:
+        route_class (str): The name of the route class, one of the keys of `limiters`.
+
+    Returns:
+        Callable: The dependency to be used with Depends().
+
+    Raises:
+        KeyError: If the route class is unknown.
+    '''
+    limiter = limiters[route_class]
+
+    async def dependency(request: Request):
+        limiter.check_rate(get_client_id(request))
+        await limiter.acquire()
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            limiter.release(time.monotonic() - start)
+
+    return dependency
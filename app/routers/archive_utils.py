@@ -0,0 +1,294 @@
+'''
+This module builds the archives served by the /files endpoints. Several archive formats are supported and the client
+selects one with the `format` query parameter or the Accept header. Built archives are cached on disk per module version
+and compression level, keyed by the checksum of the version, so the compression cost is only paid once per version.
+'''
+
+import os
+import time
+import tarfile
+import zipfile
+import asyncio
+import hashlib
+import uuid
+from dataclasses import dataclass
+from typing import Optional
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ARCHIVE_CACHE_DIR = os.getenv("ARCHIVE_CACHE_DIR", "archive_cache")
+ARCHIVE_CACHE_MAX_BYTES = int(os.getenv("ARCHIVE_CACHE_MAX_BYTES", 1024 * 1024 * 1024))
+# Archives used within this many seconds are never evicted, so a response which is about to be sent keeps its file
+ARCHIVE_CACHE_EVICT_GRACE = float(os.getenv("ARCHIVE_CACHE_EVICT_GRACE", 300))
+DEFAULT_ARCHIVE_FORMAT = os.getenv("ARCHIVE_DEFAULT_FORMAT", "zip-deflate")
+
+
+@dataclass(frozen=True)
+class ArchiveFormat:
+    name: str
+    media_type: str
+    extension: str
+    min_level: Optional[int] = None
+    max_level: Optional[int] = None
+    default_level: Optional[int] = None
+    # Levels which are actually built and cached, requested levels are snapped to the nearest of these
+    allowed_levels: tuple[int, ...] = ()
+
+
+def _levels_from_env(name: str, default: str, default_level: int) -> tuple[int, ...]:
+    levels = {int(level) for level in os.getenv(name, default).split(",") if level.strip()}
+    levels.add(default_level)
+    return tuple(sorted(levels))
+
+
+_DEFLATE_LEVEL = int(os.getenv("ARCHIVE_DEFLATE_LEVEL", 6))
+_GZIP_LEVEL = int(os.getenv("ARCHIVE_GZIP_LEVEL", 6))
+_ZSTD_LEVEL = int(os.getenv("ARCHIVE_ZSTD_LEVEL", 10))
+
+ARCHIVE_FORMATS = {
+    "zip": ArchiveFormat("zip", "application/zip", ".zip"),
+    "zip-deflate": ArchiveFormat("zip-deflate", "application/zip", ".zip", 0, 9, _DEFLATE_LEVEL, _levels_from_env("ARCHIVE_DEFLATE_LEVELS", "1,6,9", _DEFLATE_LEVEL)),
+    "tar.gz": ArchiveFormat("tar.gz", "application/gzip", ".tar.gz", 0, 9, _GZIP_LEVEL, _levels_from_env("ARCHIVE_GZIP_LEVELS", "1,6,9", _GZIP_LEVEL)),
+    "tar.zst": ArchiveFormat("tar.zst", "application/zstd", ".tar.zst", 1, 22, _ZSTD_LEVEL, _levels_from_env("ARCHIVE_ZSTD_LEVELS", "3,10,19", _ZSTD_LEVEL)),
+}
+
+# Media types accepted in the Accept header. application/zip maps to the default zip variant.
+MEDIA_TYPE_FORMATS = {
+    "application/zip": DEFAULT_ARCHIVE_FORMAT if DEFAULT_ARCHIVE_FORMAT.startswith("zip") else "zip-deflate",
+    "application/gzip": "tar.gz",
+    "application/x-gzip": "tar.gz",
+    "application/x-gtar": "tar.gz",
+    "application/zstd": "tar.zst",
+    "application/x-zstd": "tar.zst",
+}
+
+# Build lock of each archive being built and the number of requests using it, removed once the last one is done
+_build_locks: dict[str, list] = {}
+
+
+def is_safe_path_segment(name) -> bool:
+    '''
+    Whether a module name or version can be used as a single folder name below the archive cache: non-empty, without
+    separators and not "." or "..".
+    '''
+    return isinstance(name, str) and name not in ("", ".", "..") and not any(char in name for char in ("/", "\\", "\x00"))
+
+
+def is_format_available(format_name: str) -> bool:
+    return format_name in ARCHIVE_FORMATS and (format_name != "tar.zst" or zstandard is not None)
+
+
+def negotiate_archive_format(format_param: Optional[str], accept: Optional[str]) -> ArchiveFormat:
+    '''
+    Selects the archive format of a download. An explicit `format` query parameter wins, otherwise the supported media
+    type with the highest quality in the Accept header is used. Without either, the default format is used.
+
+    Args:
+        format_param (Optional[str]): The value of the `format` query parameter.
+        accept (Optional[str]): The value of the Accept header.
+
+    Returns:
+        ArchiveFormat: The selected archive format.
+
+    Raises:
+        HTTPException: 400 if the requested format is unknown, 406 if no acceptable format is available.
+    '''
+    if format_param:
+        if format_param not in ARCHIVE_FORMATS:
+            raise HTTPException(status_code=400, detail=f"Unknown archive format '{format_param}'. Supported formats: {', '.join(ARCHIVE_FORMATS)}.")
+        if not is_format_available(format_param):
+            raise HTTPException(status_code=406, detail=f"Archive format '{format_param}' is not available on this server.")
+        return ARCHIVE_FORMATS[format_param]
+
+    if not accept:
+        return ARCHIVE_FORMATS[DEFAULT_ARCHIVE_FORMAT]
+
+    candidates = []
+    for position, item in enumerate(accept.split(",")):
+        parts = [part.strip() for part in item.split(";")]
+        media_type, quality = parts[0].lower(), 1.0
+        for param in parts[1:]:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            candidates.append((-quality, position, media_type))
+
+    for _, _, media_type in sorted(candidates):
+        if media_type in ("*/*", "application/*"):
+            return ARCHIVE_FORMATS[DEFAULT_ARCHIVE_FORMAT]
+        format_name = MEDIA_TYPE_FORMATS.get(media_type)
+        if format_name and is_format_available(format_name):
+            return ARCHIVE_FORMATS[format_name]
+
+    raise HTTPException(status_code=406, detail=f"None of the accepted media types can be served. Supported formats: {', '.join(ARCHIVE_FORMATS)}.")
+
+
+def resolve_level(archive_format: ArchiveFormat, level: Optional[int]) -> Optional[int]:
+    '''
+    Validates the requested compression level against the format, falling back to the configured default.
+    Valid levels are snapped to the nearest allowed level of the format, so clients cannot fill the archive cache
+    with a copy of every version per level.
+
+    Raises:
+        HTTPException: 400 if the level is out of range for the format.
+    '''
+    if archive_format.default_level is None:
+        return None
+    if level is None:
+        return archive_format.default_level
+    if not archive_format.min_level <= level <= archive_format.max_level:
+        raise HTTPException(status_code=400, detail=f"Compression level for '{archive_format.name}' must be between {archive_format.min_level} and {archive_format.max_level}.")
+    return min(archive_format.allowed_levels, key=lambda allowed: (abs(allowed - level), allowed))
+
+
+def version_digest(version_dir: str) -> str:
+    '''
+    Returns an identifier of the content of a version folder. This is the stored checksum when available, otherwise a
+    hash of the relative paths, sizes and modification times of its files.
+    '''
+    checksum_file = os.path.join(version_dir, "checksum.txt")
+    if os.path.exists(checksum_file):
+        with open(checksum_file, "r") as f:
+            checksum = f.read().strip()
+        if checksum:
+            return checksum
+
+    stat_hash = hashlib.sha256()
+    for root, dirs, files in os.walk(version_dir):
+        dirs.sort()
+        for filename in sorted(files):
+            file_path = os.path.join(root, filename)
+            stat = os.stat(file_path)
+            stat_hash.update(f"{os.path.relpath(file_path, version_dir)}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return stat_hash.hexdigest()
+
+
+def _iter_files(version_dir: str):
+    for root, dirs, files in os.walk(version_dir):
+        dirs.sort()
+        for filename in sorted(files):
+            file_path = os.path.join(root, filename)
+            yield file_path, os.path.relpath(file_path, version_dir)
+
+
+def write_archive(version_dir: str, archive_format: ArchiveFormat, level: Optional[int], dest_path: str) -> None:
+    '''
+    Writes an archive of all files of the version folder to dest_path. This is blocking.
+    '''
+    if archive_format.name in ("zip", "zip-deflate"):
+        if archive_format.name == "zip":
+            zipf = zipfile.ZipFile(dest_path, 'w', compression=zipfile.ZIP_STORED)
+        else:
+            zipf = zipfile.ZipFile(dest_path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=level)
+        with zipf:
+            for file_path, arcname in _iter_files(version_dir):
+                zipf.write(file_path, arcname)
+
+    elif archive_format.name == "tar.gz":
+        with tarfile.open(dest_path, "w:gz", compresslevel=level) as tar:
+            for file_path, arcname in _iter_files(version_dir):
+                tar.add(file_path, arcname, recursive=False)
+
+    elif archive_format.name == "tar.zst":
+        with open(dest_path, "wb") as f:
+            with zstandard.ZstdCompressor(level=level).stream_writer(f, closefd=False) as writer:
+                with tarfile.open(fileobj=writer, mode="w|") as tar:
+                    for file_path, arcname in _iter_files(version_dir):
+                        tar.add(file_path, arcname, recursive=False)
+
+    else:
+        raise ValueError(f"Unsupported archive format {archive_format.name}")
+
+
+def _evict_cache() -> None:
+    '''
+    Removes the least recently used archives until the cache fits into ARCHIVE_CACHE_MAX_BYTES. Archives used within
+    the last ARCHIVE_CACHE_EVICT_GRACE seconds are kept, they may still be waiting to be sent.
+    '''
+    evictable_before = time.time() - ARCHIVE_CACHE_EVICT_GRACE
+    entries = []
+    total_size = 0
+    for root, dirs, files in os.walk(ARCHIVE_CACHE_DIR):
+        for filename in files:
+            if filename.endswith(".tmp"):
+                continue
+            file_path = os.path.join(root, filename)
+            try:
+                stat = os.stat(file_path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, file_path))
+            total_size += stat.st_size
+
+    for last_used, size, file_path in sorted(entries):
+        if total_size <= ARCHIVE_CACHE_MAX_BYTES or last_used > evictable_before:
+            break
+        try:
+            os.remove(file_path)
+            total_size -= size
+        except FileNotFoundError:
+            pass
+
+
+def _get_or_build_archive(module_name: str, version: str, version_dir: str, archive_format: ArchiveFormat, level: Optional[int]) -> str:
+    digest = version_digest(version_dir)
+    level_suffix = f"-{level}" if level is not None else ""
+    cache_dir = os.path.join(ARCHIVE_CACHE_DIR, module_name, version)
+    archive_path = os.path.join(cache_dir, f"{digest[:16]}-{archive_format.name}{level_suffix}{archive_format.extension}")
+
+    if os.path.exists(archive_path):
+        os.utime(archive_path)  # mark as recently used
+        return archive_path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{archive_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        write_archive(version_dir, archive_format, level, tmp_path)
+        os.replace(tmp_path, archive_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    _evict_cache()
+    return archive_path
+
+
+async def get_archive(module_name: str, version: str, version_dir: str, archive_format: ArchiveFormat, level: Optional[int]) -> str:
+    '''
+    Returns the path of the cached archive of a module version, building it in the threadpool if it is not cached yet.
+    Concurrent requests for the same archive wait for a single build.
+
+    Args:
+        module_name (str): The name of the module.
+        version (str): The version of the module.
+        version_dir (str): The path of the version folder.
+        archive_format (ArchiveFormat): The format of the archive.
+        level (Optional[int]): The compression level, None for formats without levels.
+
+    Returns:
+        str: The path of the archive file.
+
+    Raises:
+        ValueError: If the module name or version is not a plain folder name.
+        OSError: If the archive cannot be built.
+    '''
+    if not is_safe_path_segment(module_name) or not is_safe_path_segment(version):
+        raise ValueError(f"Invalid module name or version {module_name!r} {version!r}")
+    key = f"{module_name}/{version}/{archive_format.name}/{level}"
+    entry = _build_locks.setdefault(key, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            return await run_in_threadpool(_get_or_build_archive, module_name, version, version_dir, archive_format, level)
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _build_locks[key]
@@ -0,0 +1,272 @@
+'''
+This module lets mirrors replicate the registry. It has two parts:
+
+Change feed: every upload, update and delete of a module is recorded in the `change_feed` collection with a monotonic
+sequence number. Upload and update events carry the complete version -> checksum map of the module after the change,
+so a mirror only downloads the versions whose checksum differs from its copy. GET /changes?since=<seq> pages through
+the events after a cursor.
+
+Sequence numbers are taken from a counter before the event is inserted, so two concurrent writers can insert their
+events out of order. /changes therefore stops at a missing sequence number until CHANGE_FEED_GAP_GRACE seconds have
+passed since the event after it was recorded; after that the number is treated as abandoned (its insert failed).
+
+Snapshot: GET /snapshot streams an uncompressed tar with the metadata of every module in `snapshot.json` followed by
+the content of every file as a content-addressed blob (`blobs/<sha256[:2]>/<sha256>`). Files with the same content are
+stored once. The `seq` of the snapshot is the last event recorded before the export started; a mirror bootstraps from
+the snapshot and then follows /changes?since=<seq>. Events recorded while the export runs may already be contained in
+it, applying them again is harmless. The stream runs after the request handler has returned, so every blob is hashed
+again while it is added and left out if its file has changed since the metadata was written; the change feed has an
+event for that change.
+'''
+
+import io
+import os
+import json
+import time
+import hashlib
+import tarfile
+import tempfile
+import logging
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import JSONResponse, StreamingResponse
+from pymongo import ASCENDING
+from starlette.concurrency import run_in_threadpool
+from database import get_database, get_next_sequence_value
+from .admission_control import admission
+from .file_manifest import manifest_cache
+from .integrity_scrubber import integrity_scrubber
+
+router = APIRouter()
+logger = logging.getLogger(__name__)
+
+BASE_DIR = "c_cpp_modules"
+
+CHANGE_EVENT_TYPES = ("upload", "update", "delete")
+
+# How long /changes waits for a missing sequence number to be inserted before skipping it
+CHANGE_FEED_GAP_GRACE = float(os.getenv("CHANGE_FEED_GAP_GRACE", 30))
+
+# Blobs up to this size are verified in memory before they are added to a snapshot, larger ones in a temporary file
+SNAPSHOT_SPOOL_BYTES = 8 * 1024 * 1024
+
+
+def read_version_checksums(module_name: str) -> dict[str, Optional[str]]:
+    '''
+    Returns the stored checksum of every version of a module listed in its versions.json (None if it has no
+    checksum.txt). Other folders of the repository are not versions and are left out. This is blocking.
+    '''
+    module_path = os.path.join(BASE_DIR, module_name)
+    checksums = {}
+    try:
+        with open(os.path.join(module_path, "versions.json"), "r") as f:
+            listed = [item.get("version") for item in json.load(f).get("versions", []) if isinstance(item, dict)]
+    except (OSError, json.JSONDecodeError, AttributeError):
+        return checksums
+
+    for version in sorted(version for version in listed if isinstance(version, str)):
+        version_path = os.path.join(module_path, version)
+        if version in (".", "..", ".git") or "/" in version or "\\" in version or not os.path.isdir(version_path):
+            continue
+        try:
+            with open(os.path.join(version_path, "checksum.txt"), "r") as f:
+                checksums[version] = f.read().strip() or None
+        except FileNotFoundError:
+            checksums[version] = None
+    return checksums
+
+
+async def start_change_feed() -> None:
+    '''
+    Creates the index of the change feed collection.
+    '''
+    try:
+        await get_database()["change_feed"].create_index([("seq", ASCENDING)], unique=True)
+    except Exception:
+        logger.exception("Error creating change feed index")
+
+
+async def record_change(event_type: str, module_name: str, module_url: Optional[str] = None) -> Optional[int]:
+    '''
+    Appends an event to the change feed. Called after the change has been applied; errors are logged and not raised,
+    so a failing feed never fails the write itself.
+
+    Args:
+        event_type (str): "upload", "update" or "delete".
+        module_name (str): The name of the changed module.
+        module_url (Optional[str]): The repository of the module.
+
+    Returns:
+        Optional[int]: The sequence number of the event, or None if it could not be recorded.
+    '''
+    if event_type not in CHANGE_EVENT_TYPES:
+        raise ValueError(f"Unknown change event type {event_type}")
+
+    event = {"type": event_type, "module_name": module_name, "module_url": module_url}
+    try:
+        if event_type != "delete":
+            event["versions"] = await run_in_threadpool(read_version_checksums, module_name)
+        # Taken right before the insert, /changes uses it to tell a pending insert from an abandoned sequence number
+        event["at"] = time.time()
+        event["seq"] = await get_next_sequence_value("change_feed")
+        await get_database()["change_feed"].insert_one(event)
+    except Exception:
+        logger.exception("Error recording change", extra={"module_name": module_name, "event_type": event_type})
+        return None
+    return event["seq"]
+
+
+async def latest_seq() -> int:
+    latest = await get_database()["change_feed"].find_one({}, {"seq": 1}, sort=[("seq", -1)])
+    return latest["seq"] if latest else 0
+
+
+@router.get("/changes")
+async def get_changes(since: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=1000)):
+    '''
+    Returns the changes recorded after a cursor, oldest first. The page ends before a missing sequence number which
+    may still be inserted by a concurrent writer, so a mirror following next_cursor never skips an event.
+
+    Args:
+        since: The cursor, the seq of the last event already applied (0 for all events)
+        limit: The maximum number of events to return, at most 1000
+
+    Returns:
+        changes: the events, the cursor to pass as `since` for the next page and whether more events are available
+
+    Raises:
+        HTTPException: If there is an error querying the database
+    '''
+    try:
+        events = await get_database()["change_feed"].find({"seq": {"$gt": since}}, {"_id": 0}).sort("seq", ASCENDING).limit(limit + 1).to_list(limit + 1)
+    except Exception:
+        logger.exception("Database error while reading changes", extra={"since": since})
+        raise HTTPException(status_code=500, detail="Database query failed")
+
+    has_more = len(events) > limit
+    events = events[:limit]
+
+    expected_seq = since + 1
+    for position, event in enumerate(events):
+        if event["seq"] != expected_seq and time.time() - event.get("at", 0) < CHANGE_FEED_GAP_GRACE:
+            events, has_more = events[:position], False
+            break
+        expected_seq = event["seq"] + 1
+
+    return JSONResponse(content={
+        "changes": events,
+        "next_cursor": events[-1]["seq"] if events else since,
+        "has_more": has_more,
+    })
+
+
+def _add_bytes(tar: tarfile.TarFile, name: str, content: bytes) -> None:
+    info = tarfile.TarInfo(name)
+    info.size = len(content)
+    info.mtime = int(time.time())
+    tar.addfile(info, io.BytesIO(content))
+
+
+def _read_verified_blob(file_path: str, sha256: str) -> Optional[tempfile.SpooledTemporaryFile]:
+    '''
+    Copies a file into a spooled temporary file while hashing it. Returns None if the content no longer matches sha256.
+    '''
+    spool = tempfile.SpooledTemporaryFile(max_size=SNAPSHOT_SPOOL_BYTES)
+    sha256_hash = hashlib.sha256()
+    try:
+        with open(file_path, "rb") as f:
+            while chunk := f.read(65536):
+                sha256_hash.update(chunk)
+                spool.write(chunk)
+    except BaseException:
+        spool.close()
+        raise
+    if sha256_hash.hexdigest() != sha256:
+        spool.close()
+        return None
+    return spool
+
+
+def _stream_snapshot(metadata: dict, blobs: dict[str, str]):
+    '''
+    Yields the snapshot tar in chunks, the buffer is emptied after every member. This is blocking, StreamingResponse
+    iterates it in the threadpool.
+    '''
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w|") as tar:
+        _add_bytes(tar, "snapshot.json", json.dumps(metadata).encode())
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+        for sha256, file_path in blobs.items():
+            try:
+                blob = _read_verified_blob(file_path, sha256)
+            except OSError:
+                blob = None
+            if blob is None:
+                # Changed or removed since the manifest was built, the change feed covers it
+                logger.warning("Skipping blob", extra={"file_path": file_path})
+                continue
+            with blob:
+                info = tarfile.TarInfo(f"blobs/{sha256[:2]}/{sha256}")
+                info.size = blob.tell()
+                info.mtime = int(time.time())
+                blob.seek(0)
+                tar.addfile(info, blob)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+@router.get("/snapshot", dependencies=[Depends(admission("archive"))])
+async def export_snapshot():
+    '''
+    Streams a snapshot of the whole registry for bootstrapping a mirror.
+
+    Args:
+        None
+
+    Returns:
+        StreamingResponse: A tar with snapshot.json (seq, modules, versions.json and per-version file -> blob maps)
+                           followed by the blobs.
+
+    Raises:
+        HTTPException: If there is an error querying the database
+    '''
+    try:
+        seq = await latest_seq()
+        modules = await get_database()["modules"].find({}, {"_id": 0, "module_name": 1, "module_url": 1}).sort("module_name", ASCENDING).to_list(None)
+    except Exception:
+        logger.exception("Database error while exporting snapshot")
+        raise HTTPException(status_code=500, detail="Database query failed")
+
+    metadata = {"seq": seq, "created_at": time.time(), "modules": []}
+    blobs = {}
+    for module in modules:
+        module_name = module["module_name"]
+        module_path = os.path.join(BASE_DIR, module_name)
+        try:
+            with open(os.path.join(module_path, "versions.json"), "r") as f:
+                versions_json = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            logger.warning("Skipping module without readable versions.json", extra={"module_name": module_name})
+            continue
+
+        versions = {}
+        for version, checksum in (await run_in_threadpool(read_version_checksums, module_name)).items():
+            if integrity_scrubber.is_quarantined(module_name, version):
+                continue
+            version_dir = os.path.join(module_path, version)
+            manifest = await manifest_cache.get(module_name, version, version_dir)
+            versions[version] = {"checksum": checksum, "files": {path: entry.sha256 for path, entry in manifest.items()}}
+            for path, entry in manifest.items():
+                blobs.setdefault(entry.sha256, os.path.join(version_dir, path))
+
+        metadata["modules"].append({**module, "versions_json": versions_json, "versions": versions})
+
+    return StreamingResponse(_stream_snapshot(metadata, blobs), media_type="application/x-tar", headers={
+        "Content-Disposition": f"attachment; filename=cul_snapshot_{seq}.tar",
+        "X-Snapshot-Seq": str(seq)
+    })
@@ -1,14 +1,20 @@
 import hashlib
 import os
 import json
+import logging
+from typing import Callable, Optional
 
-def generate_checksum(module_path: str) -> str:
+logger = logging.getLogger(__name__)
+
+def generate_checksum(module_path: str, on_chunk: Optional[Callable[[int], None]] = None) -> str:
     '''
     Generates a SHA-256 checksum for all files in the specified folder and its subfolders (excluding .git).
     The checksum is based on the relative paths and contents of the files.
 
     Args:
         module_path (str): The path to the folder to be hashed.
+        on_chunk (Optional[Callable[[int], None]]): Called with the size of every chunk read, e.g. to throttle I/O.
+            Exceptions raised by it abort the hashing.
 
     Returns:
         str: The SHA-256 checksum as a hexadecimal string.
@@ -35,12 +41,14 @@ def generate_checksum(module_path: str) -> str:
                 with open(file_path, "rb") as f:
                     while chunk := f.read(8192):
                         sha256_hash.update(chunk)
+                        if on_chunk:
+                            on_chunk(len(chunk))
                 file_count += 1
-            except Exception as e:
-                print(f"Error reading {file_path}: {e}")
+            except OSError as e:
+                logger.warning("Error reading file", extra={"file_path": file_path, "error": str(e)})
 
     if file_count == 0:
-        print(f"No files to hash in {module_path}. Skipping.")
+        logger.info("No files to hash, skipping", extra={"module_path": module_path})
         return None
 
     return sha256_hash.hexdigest()
@@ -58,17 +66,17 @@ def generate_checksums_for_new_versions(module_path: str):
 
         checksum_file = os.path.join(version_path, "checksum.txt")
         if os.path.exists(checksum_file):
-            print(f"Skipping {version_folder} (already has checksum.txt)")
+            logger.debug("Skipping version, already has checksum.txt", extra={"version": version_folder})
             continue
 
-        print(f"Hashing new version: {version_folder}")
+        logger.info("Hashing new version", extra={"version": version_folder})
         checksum = generate_checksum(version_path)
         if checksum:
             with open(checksum_file, "w") as f:
                 f.write(checksum)
-            print(f"Checksum for {version_folder}: {checksum}")
+            logger.info("Stored checksum", extra={"version": version_folder, "checksum": checksum})
         else:
-            print(f"No files hashed for {version_folder}, checksum not written.")
+            logger.warning("No files hashed, checksum not written", extra={"version": version_folder})
 
 
 def store_checksum(module_path: str) -> None:
@@ -86,13 +94,13 @@ def store_checksum(module_path: str) -> None:
     '''
 
     if not os.path.exists(module_path):
-        print(f"Error: The folder {module_path} does not exist.")
+        logger.error("Folder does not exist", extra={"module_path": module_path})
         return
 
     checksum = generate_checksum(module_path)
     
     if not checksum:
-        print("No checksum generated.")
+        logger.warning("No checksum generated", extra={"module_path": module_path})
         return
 
     with open(os.path.join(module_path, "checksum.txt"), "w") as f:
@@ -115,7 +123,7 @@ def generate_module_checksum(module_path: str) -> int:
     version_json_path = os.path.join(module_path, "versions.json")
 
     if not os.path.exists(version_json_path):
-        print(f"Error: The file {version_json_path} does not exist.")
+        logger.error("File does not exist", extra={"file_path": version_json_path})
         return 0
 
     with open(version_json_path, "r") as f:
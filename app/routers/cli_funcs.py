@@ -1,15 +1,29 @@
 import os
 import json
-from fastapi import APIRouter, HTTPException, Depends
+import logging
+from typing import Optional
+from fastapi import APIRouter, HTTPException, Depends, Query, Request
+from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError
 from fastapi.responses import JSONResponse
 from motor.motor_asyncio import AsyncIOMotorDatabase
 from database import get_database
-from models import Module
+from models import Module, BatchVersionsRequest
+from .version_index import version_index, parse_version, InvalidVersionSpec
+from .search_index import search_index
+from .download_stats import download_stats
+from .reverse_dependencies import reverse_dependency_index
+from .response_cache import response_cache
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
 
 BASE_DIR = "c_cpp_modules"
 
+# Limits of a /get_versions_batch request
+BATCH_MAX_MODULES = int(os.getenv("BATCH_MAX_MODULES", 200))
+BATCH_MAX_BODY_BYTES = int(os.getenv("BATCH_MAX_BODY_BYTES", 64 * 1024))
+
 @router.get("/get_latest_version/{module_name}")
 async def get_latest_version(module_name: str):
     '''
@@ -42,10 +56,25 @@ async def get_latest_version(module_name: str):
             return JSONResponse(content={"latest": data.get('latest')})
     except json.JSONDecodeError:
         raise HTTPException(status_code=500, detail="Error decoding the versions.json file.")
-    except Exception as e:
-        print(f"An error occurred: {e}")
+    except Exception:
+        logger.exception("Error reading latest version", extra={"module_name": module_name})
         raise HTTPException(status_code=500, detail="An error occurred.")
 
+# module -> (stat of versions.json, latest_path read from it), so versions.json is only parsed again when it changes
+_latest_paths: dict[str, tuple[str, Optional[str]]] = {}
+
+def _latest_path(module_name: str, versions_file_path: str, versions_key: str) -> Optional[str]:
+    cached = _latest_paths.get(module_name)
+    if cached is not None and cached[0] == versions_key:
+        return cached[1]
+    try:
+        with open(versions_file_path, 'r') as file:
+            latest_path = json.load(file).get('latest_path')
+    except (OSError, json.JSONDecodeError, AttributeError):
+        latest_path = None
+    _latest_paths[module_name] = (versions_key, latest_path)
+    return latest_path
+
 @router.get("/get_versions/{module_name}")
 async def get_versions(module_name: str):
     '''
@@ -63,10 +92,6 @@ async def get_versions(module_name: str):
         Exception: If any error occurs
     '''
     versions_file_path = os.path.join(BASE_DIR, module_name, 'versions.json')
-    latest_version_path = None
-    data = None
-    module_info = None
-    data_to_send = None
     
     # Check if the module directory exists
     if not os.path.exists(os.path.join(BASE_DIR, module_name)):
@@ -76,26 +101,240 @@ async def get_versions(module_name: str):
     if not os.path.exists(versions_file_path):
         raise HTTPException(status_code=404, detail="The versions.json file is missing for the specified module.")
 
+    async def build():
+        try:
+            with open(versions_file_path, 'r') as file:
+                data = json.load(file)
+                latest_version_path = os.path.join(BASE_DIR, data.get('latest_path'),'module_info.json')
+
+            with open(latest_version_path, 'r') as file:
+                module_info = json.load(file)
+
+            data_to_send = {
+                "all_versions": data,
+                "author": module_info.get('author'),
+                "description": module_info.get('description'),
+                "license": module_info.get('license'),
+            }
+            return JSONResponse(content=data_to_send)
+        except json.JSONDecodeError:
+            raise HTTPException(status_code=500, detail="Error decoding the versions.json file.")
+        except Exception:
+            logger.exception("Error reading versions", extra={"module_name": module_name})
+            raise HTTPException(status_code=500, detail="An error occurred.")
+
+    # versions.json is rewritten whenever versions are added and the metadata comes from the module_info.json of the
+    # latest version, their stats identify the content
+    versions_stat = os.stat(versions_file_path)
+    versions_key = f"{versions_stat.st_mtime_ns}:{versions_stat.st_size}"
+    module_info_key = ""
+    latest_path = _latest_path(module_name, versions_file_path, versions_key)
+    if latest_path:
+        try:
+            module_info_stat = os.stat(os.path.join(BASE_DIR, latest_path, 'module_info.json'))
+            module_info_key = f"{module_info_stat.st_mtime_ns}:{module_info_stat.st_size}"
+        except OSError:
+            pass
+    return await response_cache.get_or_compute("get_versions", module_name, (), f"{versions_key}:{module_info_key}", build)
+
+def _is_outdated(current_version: Optional[str], latest_version: Optional[str]) -> Optional[bool]:
+    if current_version is None or latest_version is None:
+        return None
+    current_key, latest_key = parse_version(current_version), parse_version(latest_version)
+    if current_key is None or latest_key is None:
+        return current_version != latest_version
+    return current_key < latest_key
+
+async def _read_limited_body(request: Request, max_bytes: int) -> bytes:
+    '''
+    Reads the request body, rejecting it with 413 as soon as it grows past max_bytes instead of buffering all of it.
+    '''
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+        raise HTTPException(status_code=413, detail=f"Request body exceeds {max_bytes} bytes.")
+
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > max_bytes:
+            raise HTTPException(status_code=413, detail=f"Request body exceeds {max_bytes} bytes.")
+    return bytes(body)
+
+@router.post("/get_versions_batch")
+async def get_versions_batch(request: Request):
+    '''
+    Returns the latest version and all versions of several modules in one request, e.g. to check every dependency of a
+    project for updates. Served from the in-memory version and search indexes, so no files are read for known modules.
+
+    Args:
+        request: The request object, its JSON body lists the modules to look up (BatchVersionsRequest), each optionally
+                 with the version currently in use
+
+    Returns:
+        versions: per module its latest version, all versions from oldest to newest and, if a current version was
+                  given, whether it is outdated; unknown modules are listed in not_found
+
+    Raises:
+        HTTPException: If the body is larger than BATCH_MAX_BODY_BYTES or lists more than BATCH_MAX_MODULES modules
+        RequestValidationError: If the body is not a valid BatchVersionsRequest
+    '''
+    # The body is read and validated here rather than by a body parameter, so its size is capped before it is parsed
+    body = await _read_limited_body(request, BATCH_MAX_BODY_BYTES)
     try:
-        with open(versions_file_path, 'r') as file:
-            data = json.load(file)
-            latest_version_path = os.path.join(BASE_DIR, data.get('latest_path'),'module_info.json')
-            
-        with open(latest_version_path, 'r') as file:
-            module_info = json.load(file)
-
-        data_to_send = {
-            "all_versions": data,
-            "author": module_info.get('author'),
-            "description": module_info.get('description'),
-            "license": module_info.get('license'),
+        batch = BatchVersionsRequest.model_validate_json(body)
+    except ValidationError as e:
+        raise RequestValidationError([{**error, "loc": ("body", *error["loc"])} for error in e.errors(include_url=False)])
+    if len(batch.modules) > BATCH_MAX_MODULES:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_MODULES} modules can be requested at once.")
+
+    modules = {}
+    not_found = []
+    for query in batch.modules:
+        name = query.module_name
+        if name in modules or name in not_found:
+            continue
+
+        metadata = None
+        if name and "/" not in name and "\\" not in name and not name.startswith("."):
+            metadata = search_index.get_metadata(name)
+        if metadata is not None:
+            await version_index.load(name)
+        versions = version_index.sorted_versions(name) if metadata is not None else None
+        if versions is None:
+            not_found.append(name)
+            continue
+
+        modules[name] = {
+            "latest": metadata["latest"],
+            "versions": versions,
+            "current": query.current_version,
+            "current_exists": query.current_version in versions if query.current_version is not None else None,
+            "outdated": _is_outdated(query.current_version, metadata["latest"]),
+            "author": metadata["author"],
+            "description": metadata["description"],
+            "license": metadata["license"],
         }
-        return JSONResponse(content=data_to_send)
-    except json.JSONDecodeError:
-        raise HTTPException(status_code=500, detail="Error decoding the versions.json file.")
-    except Exception as e:
-        print(f"An error occurred: {e}")
-        raise HTTPException(status_code=500, detail="An error occurred.")
+
+    return JSONResponse(content={"modules": modules, "not_found": not_found})
+
+@router.get("/resolve_version/{module_name}")
+async def resolve_version(module_name: str, spec: str = "*", include_prerelease: bool = False):
+    '''
+    Returns the newest version of the specified module satisfying a semver range, e.g. ">=1.2,<2", "^1.4", "~1.2.3" or "1.x".
+    The versions are looked up in the in-memory version index, so no files are read for this request.
+
+    Args:
+        module_name: The name of the module
+        spec: The version range, defaults to "*" (any version)
+        include_prerelease: Whether pre-release versions like 1.2.0-beta.1 may match
+
+    Returns:
+        resolved version: the newest matching version and the number of matching versions
+        error message: if the module is not found, the range is invalid or no version satisfies it
+
+    Raises:
+        HTTPException: If the module is not found, the range is invalid or no version satisfies it
+    '''
+    await version_index.load(module_name)
+    try:
+        result = version_index.resolve(module_name, spec, include_prerelease)
+    except InvalidVersionSpec as e:
+        raise HTTPException(status_code=400, detail=f"Invalid version range: {e}")
+
+    if result is None:
+        raise HTTPException(status_code=404, detail=f"Module '{module_name}' not found.")
+
+    version, match_count = result
+    if version is None:
+        raise HTTPException(status_code=404, detail=f"No version of '{module_name}' satisfies '{spec}'.")
+
+    return JSONResponse(content={"module": module_name, "spec": spec, "version": version, "matches": match_count})
+
+@router.get("/search")
+async def search_modules(q: str = "", license: Optional[str] = None, author: Optional[str] = None, page: int = Query(1, ge=1), per_page: int = Query(20, ge=1, le=100)):
+    '''
+    Searches the modules by name, author, description and license, ranked by relevance. Served from the in-memory
+    search index, so no files are read for this request.
+
+    Args:
+        q: The search terms, without terms all modules passing the filters are listed alphabetically
+        license: Only return modules with this license (case-insensitive exact match)
+        author: Only return modules by this author (case-insensitive exact match)
+        page: The page of results to return, starting at 1
+        per_page: The number of results per page, at most 100
+
+    Returns:
+        search results: the total number of results and the requested page of results
+
+    Raises:
+        None
+    '''
+    total, results = search_index.search(q, license=license, author=author, offset=(page - 1) * per_page, limit=per_page)
+    return JSONResponse(content={"total": total, "page": page, "per_page": per_page, "results": results})
+
+@router.get("/download_stats")
+async def get_download_stats(limit: int = Query(10, ge=1, le=100)):
+    '''
+    Returns the most downloaded modules of all time and the trending modules of the last days.
+
+    Args:
+        limit: The number of modules in each list, at most 100
+
+    Returns:
+        download stats: the popular and trending modules with their download counts
+
+    Raises:
+        HTTPException: If there is an error querying the database
+    '''
+    try:
+        popular = await download_stats.popular_modules(limit)
+        trending = await download_stats.trending_modules(limit)
+    except Exception:
+        logger.exception("Database error while reading download stats")
+        raise HTTPException(status_code=500, detail="Database query failed")
+    return JSONResponse(content={"popular": popular, "trending": trending})
+
+@router.get("/download_stats/{module_name}")
+async def get_module_download_stats(module_name: str):
+    '''
+    Returns the download counts of every version of the specified module.
+
+    Args:
+        module_name: The name of the module
+
+    Returns:
+        download stats: the total downloads of the module and the downloads per version
+
+    Raises:
+        HTTPException: If there is an error querying the database
+    '''
+    try:
+        return JSONResponse(content=await download_stats.module_downloads(module_name))
+    except Exception:
+        logger.exception("Database error while reading download stats", extra={"module_name": module_name})
+        raise HTTPException(status_code=500, detail="Database query failed")
+
+@router.get("/dependents/{module_name}")
+async def get_dependents(module_name: str, version: Optional[str] = None):
+    '''
+    Returns the module versions which depend on the specified module, optionally only those requiring a specific version.
+
+    Args:
+        module_name: The name of the module
+        version: Only return dependents requiring this version of the module
+
+    Returns:
+        dependents: a list of the depending modules and versions with the version of the module they require
+
+    Raises:
+        HTTPException: If there is an error querying the database
+    '''
+    try:
+        dependents = await reverse_dependency_index.dependents(module_name, version)
+    except Exception:
+        logger.exception("Database error while reading dependents", extra={"module_name": module_name})
+        raise HTTPException(status_code=500, detail="Database query failed")
+    return JSONResponse(content={"module": module_name, "version": version, "dependents": dependents})
 
 @router.get("/get_modules")
 async def get_module_names(db: AsyncIOMotorDatabase = Depends(get_database)):
@@ -115,6 +354,6 @@ async def get_module_names(db: AsyncIOMotorDatabase = Depends(get_database)):
         modules = await db["modules"].find().to_list(100)
         module_list = [module["module_name"] for module in modules]
         return JSONResponse(content=module_list)
-    except Exception as e:
-        print(f"Database error: {e}")
+    except Exception:
+        logger.exception("Database error while listing modules")
         raise HTTPException(status_code=500, detail="Database query failed")
\ No newline at end of file
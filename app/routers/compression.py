@@ -0,0 +1,309 @@
+'''
+This module implements compression of dynamic responses (rendered pages, JSON). The encoding is negotiated from the
+Accept-Encoding header among zstd, br and gzip, preferring them in the order of COMPRESSION_ENCODINGS when the client
+accepts several with the same quality. zstd and br are only offered when the zstandard and brotli packages are installed.
+
+Responses are left as they are when they are smaller than COMPRESSION_MIN_SIZE, already have a Content-Encoding, are
+partial (206), or have a media type which is not text-like, so zip and tar downloads are never compressed again.
+Streaming responses are compressed chunk by chunk and flushed after every chunk, so clients receive data as it is
+produced. Large complete bodies are compressed in the threadpool to keep the event loop responsive.
+
+Per encoding, the number of responses, bytes before and after compression and the CPU time spent compressing are
+reported under "compression" by /metrics, to tune the levels under load.
+'''
+
+import os
+import time
+import zlib
+import logging
+from collections import Counter, defaultdict
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from .metrics import register_metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "true").lower() in ("1", "true", "yes")
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", 1024))
+COMPRESSION_ENCODINGS = [encoding.strip() for encoding in os.getenv("COMPRESSION_ENCODINGS", "zstd,br,gzip").split(",") if encoding.strip()]
+COMPRESSION_GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", 6))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", 4))
+COMPRESSION_ZSTD_LEVEL = int(os.getenv("COMPRESSION_ZSTD_LEVEL", 3))
+# Complete bodies at least this large are compressed in the threadpool
+COMPRESSION_THREADPOOL_MIN_SIZE = int(os.getenv("COMPRESSION_THREADPOOL_MIN_SIZE", 256 * 1024))
+
+COMPRESSIBLE_MEDIA_TYPES = {
+    "application/json",
+    "application/javascript",
+    "application/xml",
+    "application/xhtml+xml",
+    "image/svg+xml",
+}
+
+
+def is_compressible(content_type: str) -> bool:
+    media_type = content_type.split(";", 1)[0].strip().lower()
+    return media_type.startswith("text/") or media_type in COMPRESSIBLE_MEDIA_TYPES or media_type.endswith(("+json", "+xml"))
+
+
+class GzipCompressor:
+    def __init__(self):
+        self._compressor = zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+class BrotliCompressor:
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=COMPRESSION_BROTLI_QUALITY)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self) -> bytes:
+        return self._compressor.finish()
+
+
+class ZstdCompressor:
+    def __init__(self):
+        self._compressor = zstandard.ZstdCompressor(level=COMPRESSION_ZSTD_LEVEL).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH)
+
+
+COMPRESSORS = {"gzip": GzipCompressor}
+if brotli is not None:
+    COMPRESSORS["br"] = BrotliCompressor
+if zstandard is not None:
+    COMPRESSORS["zstd"] = ZstdCompressor
+
+AVAILABLE_ENCODINGS = [encoding for encoding in COMPRESSION_ENCODINGS if encoding in COMPRESSORS]
+
+
+def negotiate_encoding(accept_encoding: str) -> str:
+    '''
+    Selects the content encoding of a response from the Accept-Encoding header.
+
+    Args:
+        accept_encoding (str): The value of the Accept-Encoding header.
+
+    Returns:
+        str: The selected encoding, or None to send the response uncompressed.
+    '''
+    qualities = {}
+    for part in accept_encoding.split(","):
+        coding, _, params = part.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[coding] = quality
+
+    best, best_quality = None, 0.0
+    for encoding in AVAILABLE_ENCODINGS:
+        quality = qualities.get(encoding, qualities.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+class CompressionStats:
+    def __init__(self):
+        self._encodings = defaultdict(lambda: {"responses": 0, "streamed": 0, "bytes_in": 0, "bytes_out": 0, "cpu_seconds": 0.0})
+        self.skipped = Counter()
+
+    def record(self, encoding: str, bytes_in: int, bytes_out: int, cpu_seconds: float, streamed: bool = False) -> None:
+        stats = self._encodings[encoding]
+        stats["responses"] += 1
+        stats["streamed"] += int(streamed)
+        stats["bytes_in"] += bytes_in
+        stats["bytes_out"] += bytes_out
+        stats["cpu_seconds"] += cpu_seconds
+
+    def stats(self) -> dict:
+        encodings = {}
+        for encoding, counts in self._encodings.items():
+            encodings[encoding] = {
+                **counts,
+                "cpu_seconds": round(counts["cpu_seconds"], 6),
+                "ratio": round(counts["bytes_out"] / counts["bytes_in"], 4) if counts["bytes_in"] else None,
+                "mb_per_cpu_second": round(counts["bytes_in"] / counts["cpu_seconds"] / 1e6, 2) if counts["cpu_seconds"] else None,
+            }
+        return {
+            "enabled": COMPRESSION_ENABLED,
+            "available_encodings": AVAILABLE_ENCODINGS,
+            "min_size": COMPRESSION_MIN_SIZE,
+            "encodings": encodings,
+            "skipped": dict(self.skipped),
+        }
+
+
+compression_stats = CompressionStats()
+register_metrics("compression", compression_stats.stats)
+
+
+def _compress_body(encoding: str, body: bytes) -> tuple[bytes, float]:
+    cpu_started_at = time.thread_time()
+    compressor = COMPRESSORS[encoding]()
+    compressed = compressor.compress(body) + compressor.finish()
+    return compressed, time.thread_time() - cpu_started_at
+
+
+class CompressionMiddleware:
+    '''
+    ASGI middleware compressing text-like responses with the negotiated encoding.
+    '''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not COMPRESSION_ENABLED or scope["type"] != "http" or scope["method"] == "HEAD":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        responder = _CompressionResponder(send, encoding)
+        await self.app(scope, receive, responder.send)
+
+
+class _CompressionResponder:
+    def __init__(self, send, encoding: str):
+        self._send = send
+        self.encoding = encoding
+        self.start_message = None
+        self.headers = None
+        # None until decided, then True (compressing) or False (passing through)
+        self.active = None
+        self.buffer = b""
+        self.compressor = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_seconds = 0.0
+
+    async def send(self, message) -> None:
+        if message["type"] == "http.response.start":
+            self.start_message = message
+            self.headers = MutableHeaders(raw=list(message.get("headers", [])))
+            reason = self._skip_reason(message["status"])
+            if reason is not None:
+                compression_stats.skipped[reason] += 1
+                self.active = False
+                await self._send_start()
+            return
+
+        if message["type"] != "http.response.body" or self.active is False:
+            await self._send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+        if self.active is None:
+            self.buffer += body
+            if more_body and len(self.buffer) < COMPRESSION_MIN_SIZE:
+                return
+            if not more_body and len(self.buffer) < COMPRESSION_MIN_SIZE:
+                compression_stats.skipped["too_small"] += 1
+                self.active = False
+                await self._send_start()
+                await self._send({"type": "http.response.body", "body": self.buffer, "more_body": False})
+                return
+
+            body, self.buffer = self.buffer, b""
+            self.active = True
+            if not more_body:
+                await self._send_complete(body)
+                return
+            self.compressor = COMPRESSORS[self.encoding]()
+            self._set_encoding_headers()
+            del self.headers["content-length"]
+            await self._send_start()
+
+        chunk = self._compress(body)
+        if not more_body:
+            chunk += self._finish()
+            compression_stats.record(self.encoding, self.bytes_in, self.bytes_out, self.cpu_seconds, streamed=True)
+        if chunk or not more_body:
+            await self._send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+
+    def _skip_reason(self, status: int):
+        content_type = self.headers.get("content-type", "")
+        if not content_type or not is_compressible(content_type):
+            return "not_compressible"
+        # The response varies with Accept-Encoding from here on, compressed or not
+        self.headers.add_vary_header("Accept-Encoding")
+        if status < 200 or status in (204, 206, 304) or "content-range" in self.headers:
+            return "partial_or_empty"
+        if "content-encoding" in self.headers:
+            return "already_encoded"
+        if self.encoding is None:
+            return "not_accepted"
+        content_length = self.headers.get("content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) < COMPRESSION_MIN_SIZE:
+            return "too_small"
+        return None
+
+    def _set_encoding_headers(self) -> None:
+        self.headers["content-encoding"] = self.encoding
+        if "accept-ranges" in self.headers:
+            del self.headers["accept-ranges"]
+        # The compressed representation is not byte-identical to the one a strong ETag was computed from
+        etag = self.headers.get("etag")
+        if etag and not etag.startswith("W/"):
+            self.headers["etag"] = f"W/{etag}"
+
+    async def _send_start(self) -> None:
+        self.start_message["headers"] = self.headers.raw
+        await self._send(self.start_message)
+
+    async def _send_complete(self, body: bytes) -> None:
+        if len(body) >= COMPRESSION_THREADPOOL_MIN_SIZE:
+            compressed, cpu_seconds = await run_in_threadpool(_compress_body, self.encoding, body)
+        else:
+            compressed, cpu_seconds = _compress_body(self.encoding, body)
+        compression_stats.record(self.encoding, len(body), len(compressed), cpu_seconds)
+
+        self._set_encoding_headers()
+        self.headers["content-length"] = str(len(compressed))
+        await self._send_start()
+        await self._send({"type": "http.response.body", "body": compressed, "more_body": False})
+
+    def _compress(self, data: bytes) -> bytes:
+        cpu_started_at = time.thread_time()
+        compressed = self.compressor.compress(data) if data else b""
+        self.cpu_seconds += time.thread_time() - cpu_started_at
+        self.bytes_in += len(data)
+        self.bytes_out += len(compressed)
+        return compressed
+
+    def _finish(self) -> bytes:
+        cpu_started_at = time.thread_time()
+        compressed = self.compressor.finish()
+        self.cpu_seconds += time.thread_time() - cpu_started_at
+        self.bytes_out += len(compressed)
+        return compressed
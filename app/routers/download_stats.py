@@ -0,0 +1,210 @@
+'''
+This module counts downloads per module version. Downloads are counted in memory on the request path and written to
+MongoDB in batched $inc bulk writes by a background task, either every DOWNLOAD_STATS_FLUSH_INTERVAL seconds or as soon
+as DOWNLOAD_STATS_FLUSH_THRESHOLD downloads are pending, and once more when the app shuts down.
+
+Collections:
+    download_stats:        {module_name, version, total, last_download}
+    download_stats_daily:  {module_name, day, count}, used for trending modules
+'''
+
+import os
+import time
+import asyncio
+import logging
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from pymongo import UpdateOne, ASCENDING, DESCENDING
+from database import get_database
+from .metrics import register_metrics
+
+logger = logging.getLogger(__name__)
+
+DOWNLOAD_STATS_FLUSH_INTERVAL = float(os.getenv("DOWNLOAD_STATS_FLUSH_INTERVAL", 10))
+DOWNLOAD_STATS_FLUSH_THRESHOLD = int(os.getenv("DOWNLOAD_STATS_FLUSH_THRESHOLD", 1000))
+# Popular and trending lists are aggregated at most this often
+DOWNLOAD_STATS_CACHE_TTL = float(os.getenv("DOWNLOAD_STATS_CACHE_TTL", 60))
+TRENDING_DAYS = int(os.getenv("TRENDING_DAYS", 7))
+
+
+class DownloadStats:
+    def __init__(self):
+        self._pending: Counter = Counter()
+        self._pending_count = 0
+        self._flush_requested = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._stopping = False
+        self._task = None
+        self._summary_cache = {}
+
+        self.flushed_downloads = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.last_flush_at = None
+
+    def record(self, module_name: str, version: str) -> None:
+        '''
+        Counts a download. Only touches memory, the count is written to the database by the next flush.
+        '''
+        self._pending[(module_name, version)] += 1
+        self._pending_count += 1
+        if self._pending_count >= DOWNLOAD_STATS_FLUSH_THRESHOLD:
+            self._flush_requested.set()
+
+    async def flush(self) -> None:
+        '''
+        Writes all pending counts to the database in one bulk write per collection. On failure the counts are kept
+        and retried with the next flush.
+        '''
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, Counter()
+            pending_count, self._pending_count = self._pending_count, 0
+
+            now = datetime.now(timezone.utc)
+            day = now.strftime("%Y-%m-%d")
+            daily = Counter()
+            operations = []
+            for (module_name, version), count in pending.items():
+                operations.append(UpdateOne(
+                    {"module_name": module_name, "version": version},
+                    {"$inc": {"total": count}, "$max": {"last_download": now}},
+                    upsert=True,
+                ))
+                daily[module_name] += count
+
+            db = get_database()
+            try:
+                await db["download_stats"].bulk_write(operations, ordered=False)
+                await db["download_stats_daily"].bulk_write([
+                    UpdateOne({"module_name": module_name, "day": day}, {"$inc": {"count": count}}, upsert=True)
+                    for module_name, count in daily.items()
+                ], ordered=False)
+            except asyncio.CancelledError:
+                self._pending.update(pending)
+                self._pending_count += pending_count
+                raise
+            except Exception:
+                # Not knowing which writes were applied, re-adding everything may double count on a partial failure,
+                # which is preferable to losing the counts
+                self._pending.update(pending)
+                self._pending_count += pending_count
+                self.failed_flushes += 1
+                logger.exception("Error flushing download stats", extra={"pending": len(pending)})
+                return
+
+            self.flushes += 1
+            self.flushed_downloads += pending_count
+            self.last_flush_at = time.time()
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), timeout=DOWNLOAD_STATS_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            if self._stopping:
+                return
+            await self.flush()
+
+    async def start(self) -> None:
+        '''
+        Creates the indexes of the stats collections and starts the background flush task.
+        '''
+        # asyncio primitives bind to the event loop they are first used on. Background services create theirs here rather
+        # than in __init__, so they still work when the app is started again on a new event loop in the same process.
+        self._flush_requested = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._stopping = False
+
+        db = get_database()
+        try:
+            await db["download_stats"].create_index([("module_name", ASCENDING), ("version", ASCENDING)], unique=True)
+            await db["download_stats"].create_index([("total", DESCENDING)])
+            await db["download_stats_daily"].create_index([("module_name", ASCENDING), ("day", ASCENDING)], unique=True)
+            await db["download_stats_daily"].create_index([("day", ASCENDING)])
+        except Exception:
+            logger.exception("Error creating download stats indexes")
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        '''
+        Stops the background task and flushes the remaining counts. The task is asked to exit instead of being
+        cancelled, so a flush it is running completes (or keeps its counts on failure) before the final flush.
+        '''
+        self._stopping = True
+        self._flush_requested.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self.flush()
+
+    async def _cached(self, key: str, compute):
+        cached = self._summary_cache.get(key)
+        if cached and time.monotonic() - cached[0] < DOWNLOAD_STATS_CACHE_TTL:
+            return cached[1]
+        value = await compute()
+        self._summary_cache[key] = (time.monotonic(), value)
+        return value
+
+    async def popular_modules(self, limit: int = 10) -> list[dict]:
+        '''
+        Returns the most downloaded modules of all time.
+        '''
+        async def compute():
+            cursor = get_database()["download_stats"].aggregate([
+                {"$group": {"_id": "$module_name", "downloads": {"$sum": "$total"}}},
+                {"$sort": {"downloads": -1, "_id": 1}},
+                {"$limit": limit},
+            ])
+            return [{"module": doc["_id"], "downloads": doc["downloads"]} for doc in await cursor.to_list(limit)]
+        return await self._cached(f"popular:{limit}", compute)
+
+    async def trending_modules(self, limit: int = 10, days: int = TRENDING_DAYS) -> list[dict]:
+        '''
+        Returns the most downloaded modules of the last `days` days.
+        '''
+        async def compute():
+            since = (datetime.now(timezone.utc) - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+            cursor = get_database()["download_stats_daily"].aggregate([
+                {"$match": {"day": {"$gte": since}}},
+                {"$group": {"_id": "$module_name", "downloads": {"$sum": "$count"}}},
+                {"$sort": {"downloads": -1, "_id": 1}},
+                {"$limit": limit},
+            ])
+            return [{"module": doc["_id"], "downloads": doc["downloads"]} for doc in await cursor.to_list(limit)]
+        return await self._cached(f"trending:{limit}:{days}", compute)
+
+    async def module_downloads(self, module_name: str) -> dict:
+        '''
+        Returns the download counts of every version of a module and their total.
+        '''
+        documents = await get_database()["download_stats"].find({"module_name": module_name}).to_list(None)
+        versions = {doc["version"]: doc["total"] for doc in documents}
+        return {"module": module_name, "total": sum(versions.values()), "versions": versions}
+
+    async def module_totals(self, module_names: list[str]) -> dict[str, int]:
+        '''
+        Returns the total downloads of each of the given modules.
+        '''
+        cursor = get_database()["download_stats"].aggregate([
+            {"$match": {"module_name": {"$in": module_names}}},
+            {"$group": {"_id": "$module_name", "downloads": {"$sum": "$total"}}},
+        ])
+        return {doc["_id"]: doc["downloads"] for doc in await cursor.to_list(None)}
+
+    def stats(self) -> dict:
+        return {
+            "pending_downloads": self._pending_count,
+            "pending_keys": len(self._pending),
+            "flushed_downloads": self.flushed_downloads,
+            "flushes": self.flushes,
+            "failed_flushes": self.failed_flushes,
+            "last_flush_at": self.last_flush_at,
+        }
+
+
+download_stats = DownloadStats()
+register_metrics("download_stats", download_stats.stats)
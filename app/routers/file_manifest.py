@@ -0,0 +1,107 @@
+'''
+This module keeps per-version file manifests used by the raw file endpoints. A manifest maps the relative path of every
+file of a version folder (excluding .git and checksum.txt) to the SHA-256 and size of its content. The hash is used as
+the ETag of the file, so it only changes when the content of that file changes.
+
+Manifests are built on first access in the threadpool and cached in memory per version, keyed by the version digest,
+so a re-ingested version gets a new manifest. At most FILE_MANIFEST_CACHE_SIZE manifests are kept.
+'''
+
+import os
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from starlette.concurrency import run_in_threadpool
+from .archive_utils import version_digest
+
+logger = logging.getLogger(__name__)
+
+FILE_MANIFEST_CACHE_SIZE = int(os.getenv("FILE_MANIFEST_CACHE_SIZE", 256))
+
+_EXCLUDED_FILES = {"checksum.txt"}
+
+
+@dataclass(frozen=True)
+class ManifestEntry:
+    sha256: str
+    size: int
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.sha256}"'
+
+
+def build_manifest(version_dir: str) -> dict[str, ManifestEntry]:
+    '''
+    Hashes every file of a version folder. Paths use "/" as separator. This is blocking.
+    '''
+    manifest = {}
+    real_version_dir = os.path.realpath(version_dir)
+    for root, dirs, files in os.walk(version_dir):
+        dirs[:] = sorted(d for d in dirs if d != ".git")
+        for filename in sorted(files):
+            file_path = os.path.join(root, filename)
+            relative_path = os.path.relpath(file_path, version_dir).replace(os.sep, "/")
+            if relative_path in _EXCLUDED_FILES or not os.path.isfile(file_path):
+                continue
+            if not os.path.realpath(file_path).startswith(real_version_dir + os.sep):
+                # Symlinks pointing outside the version folder are never served or exported
+                continue
+            sha256_hash = hashlib.sha256()
+            size = 0
+            try:
+                with open(file_path, "rb") as f:
+                    while chunk := f.read(65536):
+                        sha256_hash.update(chunk)
+                        size += len(chunk)
+            except OSError as e:
+                logger.warning("Error reading file", extra={"file_path": file_path, "error": str(e)})
+                continue
+            manifest[relative_path] = ManifestEntry(sha256_hash.hexdigest(), size)
+    return manifest
+
+
+class ManifestCache:
+    def __init__(self, max_entries: int = FILE_MANIFEST_CACHE_SIZE):
+        self.max_entries = max_entries
+        # "module/version" -> (version digest, manifest), least recently used first
+        self._manifests: OrderedDict[str, tuple[str, dict[str, ManifestEntry]]] = OrderedDict()
+        self._locks: dict[str, asyncio.Lock] = {}
+
+    def _lookup(self, key: str, version_dir: str):
+        digest = version_digest(version_dir)
+        cached = self._manifests.get(key)
+        if cached is not None and cached[0] == digest:
+            return digest, cached[1]
+        return digest, None
+
+    async def get(self, module_name: str, version: str, version_dir: str) -> dict[str, ManifestEntry]:
+        '''
+        Returns the manifest of a version, building it if it is not cached or the content of the version changed.
+        Concurrent requests for the same version wait for a single build.
+        '''
+        key = f"{module_name}/{version}"
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            digest, manifest = await run_in_threadpool(self._lookup, key, version_dir)
+            if manifest is None:
+                manifest = await run_in_threadpool(build_manifest, version_dir)
+                self._manifests[key] = (digest, manifest)
+            self._manifests.move_to_end(key)
+            while len(self._manifests) > self.max_entries:
+                evicted, _ = self._manifests.popitem(last=False)
+                self._locks.pop(evicted, None)
+        return manifest
+
+    def invalidate(self, module_name: str) -> None:
+        '''
+        Drops the cached manifests of every version of a module.
+        '''
+        prefix = f"{module_name}/"
+        for key in [key for key in self._manifests if key.startswith(prefix)]:
+            del self._manifests[key]
+
+
+manifest_cache = ManifestCache()
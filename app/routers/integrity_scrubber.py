@@ -0,0 +1,249 @@
+'''
+This module implements a background scrubber which re-verifies the stored checksum.txt of every module version against
+its content, using the same hashing as generate_checksum. Reads are throttled to SCRUB_IO_BYTES_PER_SEC and hashing to
+a SCRUB_CPU_FRACTION share of a core, so the scrubber does not compete with requests.
+
+Progress (the last verified version of the current pass) and the set of quarantined versions are saved to
+SCRUB_STATE_FILE after every version, so a restart resumes the pass where it stopped. Versions whose content no longer
+matches their checksum are quarantined and not served by the /files endpoints until a later pass verifies them again.
+'''
+
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+from starlette.concurrency import run_in_threadpool
+from .checksum_utils import generate_checksum
+from .metrics import register_metrics
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = "c_cpp_modules"
+
+SCRUB_ENABLED = os.getenv("SCRUB_ENABLED", "true").lower() in ("1", "true", "yes")
+SCRUB_IO_BYTES_PER_SEC = int(os.getenv("SCRUB_IO_BYTES_PER_SEC", 5 * 1024 * 1024))
+SCRUB_CPU_FRACTION = float(os.getenv("SCRUB_CPU_FRACTION", 0.2))
+# Pause between the end of a pass and the start of the next one
+SCRUB_PASS_INTERVAL = float(os.getenv("SCRUB_PASS_INTERVAL", 24 * 60 * 60))
+SCRUB_STATE_FILE = os.getenv("SCRUB_STATE_FILE", "scrub_state.json")
+
+
+class ScrubAborted(Exception):
+    pass
+
+
+class Throttle:
+    '''
+    Called for every chunk read, sleeps as long as needed to keep the read rate below the I/O limit and the CPU time
+    of the thread below its share of the elapsed time. Raises ScrubAborted when the scrubber is stopped.
+    '''
+
+    def __init__(self, bytes_per_sec: int, cpu_fraction: float, stop_event: threading.Event):
+        self.bytes_per_sec = bytes_per_sec
+        self.cpu_fraction = cpu_fraction
+        self.stop_event = stop_event
+        self.bytes_read = 0
+        self.started_at = time.monotonic()
+        self.cpu_started_at = time.thread_time()
+
+    def __call__(self, chunk_size: int) -> None:
+        self.bytes_read += chunk_size
+        elapsed = time.monotonic() - self.started_at
+
+        required = 0.0
+        if self.bytes_per_sec > 0:
+            required = self.bytes_read / self.bytes_per_sec
+        if 0 < self.cpu_fraction < 1:
+            required = max(required, (time.thread_time() - self.cpu_started_at) / self.cpu_fraction)
+
+        if required > elapsed:
+            if self.stop_event.wait(required - elapsed):
+                raise ScrubAborted()
+        elif self.stop_event.is_set():
+            raise ScrubAborted()
+
+
+class IntegrityScrubber:
+    def __init__(self, base_dir: str = BASE_DIR, state_file: str = SCRUB_STATE_FILE):
+        self.base_dir = base_dir
+        self.state_file = state_file
+        self._stop_event = threading.Event()
+        self._task = None
+        # Guards state["quarantined"], which is changed from threadpool workers and read by request handlers
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+
+        self.state = {
+            "pass": 0,
+            "cursor": None,            # "module/version" last verified in the current pass
+            "pass_started_at": None,
+            "last_pass_completed_at": None,
+            "quarantined": {},         # "module/version" -> {"expected": ..., "actual": ..., "detected_at": ...}
+        }
+        self.current = None
+        self.versions_verified = 0
+        self.mismatches = 0
+        self.bytes_read = 0
+        self._load_state()
+
+    def _load_state(self) -> None:
+        try:
+            with open(self.state_file, "r") as f:
+                self.state.update(json.load(f))
+        except FileNotFoundError:
+            pass
+        except (OSError, json.JSONDecodeError):
+            logger.warning("Could not read scrub state, starting a new pass", extra={"state_file": self.state_file})
+
+    def _save_state(self) -> None:
+        with self._lock:
+            data = json.dumps(self.state)
+        with self._save_lock:
+            tmp_path = f"{self.state_file}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write(data)
+            os.replace(tmp_path, self.state_file)
+
+    def is_quarantined(self, module_name: str, version: str) -> bool:
+        return f"{module_name}/{version}" in self.state["quarantined"]
+
+    def release(self, module_name: str, versions: list[str]) -> None:
+        '''
+        Drops versions from quarantine after they have been re-ingested with a new checksum, the next pass verifies them.
+        This writes the state file, so call it in the threadpool.
+        '''
+        with self._lock:
+            released = [self.state["quarantined"].pop(f"{module_name}/{version}", None) for version in versions]
+        if any(entry is not None for entry in released):
+            self._save_state()
+
+    def _list_versions(self) -> list[str]:
+        '''
+        Returns "module/version" of every version folder with a stored checksum, in a stable order.
+        '''
+        keys = []
+        if not os.path.isdir(self.base_dir):
+            return keys
+        for module_name in sorted(os.listdir(self.base_dir)):
+            module_path = os.path.join(self.base_dir, module_name)
+            if not os.path.isdir(module_path):
+                continue
+            for version in sorted(os.listdir(module_path)):
+                if version != ".git" and os.path.isfile(os.path.join(module_path, version, "checksum.txt")):
+                    keys.append(f"{module_name}/{version}")
+        return keys
+
+    def verify_version(self, key: str) -> None:
+        '''
+        Re-computes the checksum of a version and updates its quarantine status. This is blocking and throttled.
+        '''
+        version_path = os.path.join(self.base_dir, key)
+        try:
+            with open(os.path.join(version_path, "checksum.txt"), "r") as f:
+                expected = f.read().strip()
+        except FileNotFoundError:
+            # Deleted or re-ingested since it was listed
+            with self._lock:
+                self.state["quarantined"].pop(key, None)
+            return
+
+        throttle = Throttle(SCRUB_IO_BYTES_PER_SEC, SCRUB_CPU_FRACTION, self._stop_event)
+        try:
+            actual = generate_checksum(version_path, on_chunk=throttle)
+        finally:
+            self.bytes_read += throttle.bytes_read
+
+        self.versions_verified += 1
+        if actual == expected:
+            with self._lock:
+                released = self.state["quarantined"].pop(key, None)
+            if released:
+                logger.info("Version verified again, released from quarantine", extra={"version": key})
+            return
+
+        self.mismatches += 1
+        with self._lock:
+            newly_quarantined = key not in self.state["quarantined"]
+            self.state["quarantined"][key] = {"expected": expected, "actual": actual, "detected_at": time.time()}
+        if newly_quarantined:
+            logger.error("Checksum mismatch, version quarantined", extra={"version": key, "expected": expected, "actual": actual})
+
+    async def _run_pass(self) -> None:
+        if self.state["cursor"] is None:
+            self.state["pass_started_at"] = time.time()
+
+        keys = await run_in_threadpool(self._list_versions)
+        cursor = tuple(self.state["cursor"].split("/", 1)) if self.state["cursor"] else None
+        # Quarantined versions which no longer exist are dropped
+        with self._lock:
+            for key in set(self.state["quarantined"]) - set(keys):
+                del self.state["quarantined"][key]
+
+        for key in keys:
+            if cursor is not None and tuple(key.split("/", 1)) <= cursor:
+                continue
+            self.current = key
+            try:
+                await run_in_threadpool(self.verify_version, key)
+            except ScrubAborted:
+                return
+            finally:
+                self.current = None
+            self.state["cursor"] = key
+            await run_in_threadpool(self._save_state)
+
+        self.state["pass"] += 1
+        self.state["cursor"] = None
+        self.state["last_pass_completed_at"] = time.time()
+        await run_in_threadpool(self._save_state)
+        logger.info("Integrity scrub pass completed", extra={"versions": len(keys), "quarantined": len(self.state["quarantined"])})
+
+    async def _run(self) -> None:
+        while not self._stop_event.is_set():
+            try:
+                await self._run_pass()
+            except Exception:
+                logger.exception("Integrity scrub pass failed")
+            if self._stop_event.is_set():
+                return
+            await asyncio.sleep(SCRUB_PASS_INTERVAL)
+
+    def start(self) -> None:
+        if SCRUB_ENABLED:
+            self._stop_event.clear()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        '''
+        Stops the scrubber. A version being verified is abandoned and verified again after the next start.
+        '''
+        self._stop_event.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            quarantined = sorted(self.state["quarantined"])
+        return {
+            "enabled": SCRUB_ENABLED,
+            "pass": self.state["pass"],
+            "cursor": self.state["cursor"],
+            "current": self.current,
+            "pass_started_at": self.state["pass_started_at"],
+            "last_pass_completed_at": self.state["last_pass_completed_at"],
+            "versions_verified": self.versions_verified,
+            "mismatches": self.mismatches,
+            "bytes_read": self.bytes_read,
+            "quarantined": quarantined,
+        }
+
+
+integrity_scrubber = IntegrityScrubber()
+register_metrics("integrity_scrub", integrity_scrubber.stats)
@@ -2,13 +2,51 @@
 This module defines a simple keep-alive endpoint for the FastAPI application.
 This endpoint can be used to check if the server is running and responsive.
 Currently, it is being used to keep render from spinning down the server.
+
+It also defines a readiness endpoint which the load balancer can use to route away from a degraded node.
 '''
 
-from fastapi import APIRouter
-from fastapi.responses import PlainTextResponse
+import time
+import logging
+from fastapi import APIRouter, Depends
+from fastapi.responses import PlainTextResponse, JSONResponse
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from database import get_database, settings, pool_listener
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
 
 @router.get("/ping", response_class=PlainTextResponse)
 async def ping():
     return "A"
+
+@router.get("/ready")
+async def ready(db: AsyncIOMotorDatabase = Depends(get_database)):
+    '''
+    Reports whether this node is ready to serve traffic, along with the database round-trip latency and connection pool utilization.
+    Returns 503 if the database cannot be reached or if latency or pool utilization exceed the configured thresholds.
+
+    Args:
+        db: The database connection object
+
+    Returns:
+        JSONResponse: The readiness status, latency in milliseconds and pool statistics.
+
+    Raises:
+        None
+    '''
+    pool = pool_listener.snapshot(settings.DB_MAX_POOL_SIZE)
+
+    start = time.perf_counter()
+    try:
+        await db.command("ping")
+    except Exception as e:
+        logger.warning("Readiness check failed", extra={"error": str(e)})
+        return JSONResponse(status_code=503, content={"status": "unavailable", "error": "Database unreachable", "pool": pool})
+    latency_ms = round((time.perf_counter() - start) * 1000, 2)
+
+    degraded = latency_ms > settings.READY_MAX_LATENCY_MS or pool["utilization"] > settings.READY_MAX_POOL_UTILIZATION
+    return JSONResponse(
+        status_code=503 if degraded else 200,
+        content={"status": "degraded" if degraded else "ok", "db_latency_ms": latency_ms, "pool": pool},
+    )
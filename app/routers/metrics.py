@@ -0,0 +1,54 @@
+'''
+This module exposes runtime metrics of the backend as JSON. Other modules register a callable returning a dict of their
+current numbers under a name with register_metrics(), and GET /metrics collects all of them into a single response.
+'''
+
+import logging
+from typing import Callable
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+
+router = APIRouter()
+logger = logging.getLogger(__name__)
+
+_metric_sources: dict[str, Callable[[], dict]] = {}
+
+def register_metrics(name: str, source: Callable[[], dict]) -> None:
+    '''
+    Registers a metrics source that is reported under the given name by /metrics.
+
+    Args:
+        name (str): The key under which the metrics are reported.
+        source (Callable[[], dict]): A callable returning the current metrics as a JSON serializable dict.
+
+    Returns:
+        None
+
+    Raises:
+        None
+    '''
+    _metric_sources[name] = source
+
+
+@router.get("/metrics")
+async def get_metrics():
+    '''
+    Returns the current metrics of all registered sources.
+
+    Args:
+        None
+
+    Returns:
+        JSONResponse: A JSON object mapping each source name to its metrics.
+
+    Raises:
+        None
+    '''
+    content = {}
+    for name, source in _metric_sources.items():
+        try:
+            content[name] = source()
+        except Exception:
+            logger.exception("Error collecting metrics", extra={"source": name})
+            content[name] = {"error": "unavailable"}
+    return JSONResponse(content=content)
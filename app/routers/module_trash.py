@@ -0,0 +1,252 @@
+'''
+This module implements deferred deletion of module folders. Instead of removing a folder in the request handler,
+tombstone() renames it into TRASH_DIR, which is a single atomic rename, and a background reaper deletes the contents of
+the trash afterwards at no more than TRASH_REAP_FILES_PER_SEC files per second.
+
+The trash folder itself is the queue: every entry in it is pending deletion. A restart, even after a crash in the
+middle of deleting an entry, simply continues with whatever is left in the trash. TRASH_DIR has to be on the same
+filesystem as the module folders for the rename to be atomic; if the rename fails the folder is deleted directly.
+'''
+
+import os
+import stat
+import time
+import uuid
+import shutil
+import asyncio
+import logging
+import threading
+from typing import Optional
+from starlette.concurrency import run_in_threadpool
+from .metrics import register_metrics
+
+logger = logging.getLogger(__name__)
+
+TRASH_DIR = os.getenv("TRASH_DIR", "module_trash")
+TRASH_REAP_FILES_PER_SEC = float(os.getenv("TRASH_REAP_FILES_PER_SEC", 500))
+# Pause between checks of an empty trash; new tombstones wake the reaper immediately
+TRASH_REAP_INTERVAL = float(os.getenv("TRASH_REAP_INTERVAL", 60))
+
+
+class ReapAborted(Exception):
+    pass
+
+
+def handle_remove_readonly(func, path, exc_info):
+    '''
+    This function removes the read-only attribute from a file or directory and then calls the provided function.
+
+    Args:
+        func (function): The function to call.
+        path (str): The path to the file or directory.
+        exc_info (tuple): The exception information.
+
+    Returns:
+        None
+
+    Raises:
+        None
+    '''
+    os.chmod(path, stat.S_IWRITE)
+    func(path)
+
+
+class ModuleReaper:
+    def __init__(self, trash_dir: str = TRASH_DIR):
+        self.trash_dir = trash_dir
+        self._stop_event = threading.Event()
+        self._wake = asyncio.Event()
+        self._task = None
+
+        # trash entry -> bytes not deleted yet, for entries measured by the reaper. Changed by the reaper thread and
+        # read by stats(), so only accessed under _lock
+        self._pending_bytes: dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.current = None
+        self.tombstoned = 0
+        self.direct_deletes = 0
+        self.reclaimed_entries = 0
+        self.reclaimed_files = 0
+        self.reclaimed_bytes = 0
+        self.failures = 0
+
+    def tombstone(self, path: str) -> Optional[str]:
+        '''
+        Moves a folder into the trash, so that its original path is free immediately. The contents are deleted later
+        by the reaper. If the folder cannot be moved it is deleted right away.
+
+        Args:
+            path (str): The folder to delete.
+
+        Returns:
+            Optional[str]: The path of the folder in the trash, or None if it did not exist or was deleted directly.
+        '''
+        if not os.path.exists(path):
+            return None
+
+        # Sortable by tombstone time, so entries are reaped oldest first
+        trash_path = os.path.join(self.trash_dir, f"{time.time_ns()}-{uuid.uuid4().hex[:8]}-{os.path.basename(os.path.normpath(path))}")
+        try:
+            os.makedirs(self.trash_dir, exist_ok=True)
+            os.rename(path, trash_path)
+        except OSError:
+            logger.warning("Could not move folder to trash, deleting it directly", extra={"path": path}, exc_info=True)
+            shutil.rmtree(path, onerror=handle_remove_readonly)
+            self.direct_deletes += 1
+            return None
+
+        self.tombstoned += 1
+        self._wake.set()
+        logger.info("Moved folder to trash", extra={"path": path, "trash_path": trash_path})
+        return trash_path
+
+    def _list_entries(self) -> list[str]:
+        try:
+            return sorted(os.listdir(self.trash_dir))
+        except FileNotFoundError:
+            return []
+
+    def _scan(self) -> list[str]:
+        '''
+        Lists the trash entries and measures the ones not measured yet, for the pending bytes metric. This is blocking.
+        '''
+        entries = self._list_entries()
+        with self._lock:
+            for entry in set(self._pending_bytes) - set(entries):
+                del self._pending_bytes[entry]
+            unmeasured = [entry for entry in entries if entry not in self._pending_bytes]
+        for entry in unmeasured:
+            size = self._measure(os.path.join(self.trash_dir, entry))
+            with self._lock:
+                self._pending_bytes.setdefault(entry, size)
+        return entries
+
+    def _measure(self, entry_path: str) -> int:
+        total = 0
+        for root, dirs, files in os.walk(entry_path):
+            for filename in files:
+                try:
+                    total += os.lstat(os.path.join(root, filename)).st_size
+                except OSError:
+                    pass
+        return total
+
+    def reap_entry(self, entry: str) -> None:
+        '''
+        Deletes one trash entry file by file, bottom-up, throttled to TRASH_REAP_FILES_PER_SEC. This is blocking.
+        Raises ReapAborted when the reaper is stopped; the rest of the entry is deleted after the next start.
+        '''
+        entry_path = os.path.join(self.trash_dir, entry)
+        if not os.path.isdir(entry_path) or os.path.islink(entry_path):
+            os.remove(entry_path)
+            with self._lock:
+                self._pending_bytes.pop(entry, None)
+            return
+
+        with self._lock:
+            measured = entry in self._pending_bytes
+        if not measured:
+            size = self._measure(entry_path)
+            with self._lock:
+                self._pending_bytes.setdefault(entry, size)
+        started_at = time.monotonic()
+        files_deleted = 0
+
+        for root, dirs, files in os.walk(entry_path, topdown=False):
+            for filename in files:
+                file_path = os.path.join(root, filename)
+                try:
+                    size = os.lstat(file_path).st_size
+                    try:
+                        os.remove(file_path)
+                    except PermissionError:
+                        handle_remove_readonly(os.remove, file_path, None)
+                except FileNotFoundError:
+                    continue
+
+                files_deleted += 1
+                self.reclaimed_files += 1
+                self.reclaimed_bytes += size
+                with self._lock:
+                    self._pending_bytes[entry] = max(0, self._pending_bytes.get(entry, 0) - size)
+
+                if TRASH_REAP_FILES_PER_SEC > 0:
+                    delay = files_deleted / TRASH_REAP_FILES_PER_SEC - (time.monotonic() - started_at)
+                    if delay > 0 and self._stop_event.wait(delay):
+                        raise ReapAborted()
+                if self._stop_event.is_set():
+                    raise ReapAborted()
+
+            for dirname in dirs:
+                dir_path = os.path.join(root, dirname)
+                if os.path.islink(dir_path):
+                    os.remove(dir_path)
+                else:
+                    os.rmdir(dir_path)
+
+        os.rmdir(entry_path)
+        with self._lock:
+            self._pending_bytes.pop(entry, None)
+        self.reclaimed_entries += 1
+
+    async def _run(self) -> None:
+        while not self._stop_event.is_set():
+            self._wake.clear()
+            for entry in await run_in_threadpool(self._scan):
+                self.current = entry
+                try:
+                    await run_in_threadpool(self.reap_entry, entry)
+                    logger.info("Reclaimed trash entry", extra={"entry": entry})
+                except ReapAborted:
+                    return
+                except OSError:
+                    self.failures += 1
+                    logger.exception("Error reclaiming trash entry", extra={"entry": entry})
+                finally:
+                    self.current = None
+
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=TRASH_REAP_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self) -> None:
+        # Recreated per start, see DownloadStats.start()
+        self._wake = asyncio.Event()
+        self._stop_event.clear()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        '''
+        Stops the reaper. A partially deleted entry stays in the trash and is finished after the next start.
+        '''
+        self._stop_event.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        entries = self._list_entries()
+        with self._lock:
+            pending_bytes = dict(self._pending_bytes)
+        return {
+            "pending_entries": len(entries),
+            "pending_bytes": sum(pending_bytes.values()),
+            # Tombstoned since the last scan of the reaper, not included in pending_bytes yet
+            "unmeasured_entries": len([entry for entry in entries if entry not in pending_bytes]),
+            "current": self.current,
+            "tombstoned": self.tombstoned,
+            "direct_deletes": self.direct_deletes,
+            "reclaimed_entries": self.reclaimed_entries,
+            "reclaimed_files": self.reclaimed_files,
+            "reclaimed_bytes": self.reclaimed_bytes,
+            "failures": self.failures,
+        }
+
+
+module_reaper = ModuleReaper()
+register_metrics("trash", module_reaper.stats)
@@ -1,5 +1,9 @@
+import os
+import logging
 from pathlib import Path
 
+logger = logging.getLogger(__name__)
+
 # Define which file extensions you want to normalize
 TEXT_EXTS = {
     ".c", ".cpp", ".h", ".hpp",
@@ -23,7 +27,7 @@ def normalize_line_endings(file_path: str):
     try:
         raw = p.read_bytes()
     except Exception as e:
-        print(f"[normalize] could not read {file_path}: {e}")
+        logger.warning("could not read file", extra={"file_path": file_path, "error": str(e)})
         return
 
     if not raw:
@@ -34,8 +38,17 @@ def normalize_line_endings(file_path: str):
     if normalized != raw:
         try:
             p.write_bytes(normalized)
-            print(f"[normalize] normalized {file_path}")
+            logger.info("normalized line endings", extra={"file_path": file_path})
             return
         except Exception as e:
-            print(f"[normalize] could not write {file_path}: {e}")
+            logger.warning("could not write file", extra={"file_path": file_path, "error": str(e)})
             return
+
+
+def normalize_module_line_endings(module_folder: str):
+    """
+    Normalize line endings of every file inside the given module folder.
+    """
+    for root, dirs, files in os.walk(module_folder):
+        for file in files:
+            normalize_line_endings(os.path.join(root, file))
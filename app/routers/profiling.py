@@ -0,0 +1,185 @@
+'''
+This module implements opt-in per-request profiling. A request is profiled with cProfile when it carries the admin
+X-Profile header (matching the PROFILING_TOKEN environment variable) or when it is picked by the sampling rate
+PROFILE_SAMPLE_RATE. Captures are written to a bounded ring of files on disk together with their route and latency,
+and can be listed and downloaded by admins through /profiles.
+
+When profiling is disabled (no token and a sampling rate of 0) the middleware passes requests straight through.
+
+Note: cProfile records the event loop thread, so work offloaded to the threadpool is only visible as the time spent
+awaiting it, and other requests interleaving on the loop during the capture show up in the profile as well.
+'''
+
+import os
+import json
+import logging
+import time
+import uuid
+import random
+import cProfile
+import secrets
+from typing import Optional
+from fastapi import APIRouter, HTTPException, Header
+from fastapi.responses import JSONResponse, FileResponse
+from starlette.concurrency import run_in_threadpool
+
+PROFILING_TOKEN = os.getenv("PROFILING_TOKEN")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_MAX_CAPTURES = int(os.getenv("PROFILE_MAX_CAPTURES", 50))
+
+PROFILING_ENABLED = bool(PROFILING_TOKEN) or PROFILE_SAMPLE_RATE > 0
+
+router = APIRouter()
+logger = logging.getLogger(__name__)
+
+# cProfile cannot run several profilers at once, requests arriving while a capture is active are not profiled
+_capture_active = False
+
+
+def _is_admin(token: Optional[bytes]) -> bool:
+    # Compared as bytes, compare_digest raises TypeError for str values with non-ASCII characters
+    return bool(PROFILING_TOKEN) and bool(token) and secrets.compare_digest(token, PROFILING_TOKEN.encode())
+
+
+def _header_bytes(value: Optional[str]) -> Optional[bytes]:
+    # Header values are decoded as latin-1 by Starlette, so this gives back the raw bytes
+    return value.encode("latin-1") if value is not None else None
+
+
+def _write_capture(profiler: cProfile.Profile, metadata: dict) -> None:
+    '''
+    Writes a capture and its metadata to PROFILE_DIR and removes the oldest captures beyond PROFILE_MAX_CAPTURES.
+    '''
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    profiler.dump_stats(os.path.join(PROFILE_DIR, f"{metadata['id']}.prof"))
+    with open(os.path.join(PROFILE_DIR, f"{metadata['id']}.json"), "w") as f:
+        json.dump(metadata, f)
+
+    captures = sorted(name[:-len(".json")] for name in os.listdir(PROFILE_DIR) if name.endswith(".json"))
+    for capture_id in captures[:max(0, len(captures) - PROFILE_MAX_CAPTURES)]:
+        for extension in (".json", ".prof"):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, capture_id + extension))
+            except FileNotFoundError:
+                pass
+
+
+class ProfilingMiddleware:
+    '''
+    ASGI middleware profiling the requests selected by the admin header or the sampling rate.
+    '''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        # Requests to /profiles carry the admin header too, profiling them would only churn the ring
+        if not PROFILING_ENABLED or scope["type"] != "http" or scope["path"].startswith("/profiles"):
+            await self.app(scope, receive, send)
+            return
+
+        trigger = None
+        if PROFILING_TOKEN:
+            for name, value in scope["headers"]:
+                if name == b"x-profile" and _is_admin(value):
+                    trigger = "header"
+                    break
+        if trigger is None and PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+            trigger = "sample"
+
+        global _capture_active
+        if trigger is None or _capture_active:
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        _capture_active = True
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        profiler.enable()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            profiler.disable()
+            _capture_active = False
+            latency_ms = (time.perf_counter() - start) * 1000
+
+            route = scope.get("route")
+            metadata = {
+                # Sortable by creation time, the ring is trimmed in this order
+                "id": f"{time.time_ns()}-{uuid.uuid4().hex[:8]}",
+                "created_at": time.time(),
+                "method": scope["method"],
+                "path": scope["path"],
+                "route": getattr(route, "path", None),
+                "status_code": status_code,
+                "latency_ms": round(latency_ms, 2),
+                "trigger": trigger,
+            }
+            try:
+                await run_in_threadpool(_write_capture, profiler, metadata)
+            except Exception:
+                logger.exception("Error writing profile capture")
+
+
+@router.get("/profiles")
+async def list_profiles(x_profile: str = Header(None)):
+    '''
+    Lists the stored profile captures, newest first. Only available to admins.
+
+    Args:
+        x_profile (str): The admin profiling token, sent as the X-Profile header.
+
+    Returns:
+        JSONResponse: The metadata of all stored captures.
+
+    Raises:
+        HTTPException: If the token is missing or invalid.
+    '''
+    if not _is_admin(_header_bytes(x_profile)):
+        raise HTTPException(status_code=403, detail="Not authorized.")
+
+    captures = []
+    if os.path.isdir(PROFILE_DIR):
+        for name in sorted(os.listdir(PROFILE_DIR), reverse=True):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(PROFILE_DIR, name), "r") as f:
+                    captures.append(json.load(f))
+            except (OSError, json.JSONDecodeError):
+                continue  # trimmed or being written concurrently
+    return JSONResponse(content=captures)
+
+
+@router.get("/profiles/{capture_id}")
+async def download_profile(capture_id: str, x_profile: str = Header(None)):
+    '''
+    Downloads a profile capture in pstats format, readable with `python -m pstats` or snakeviz. Only available to admins.
+
+    Args:
+        capture_id (str): The id of the capture as returned by /profiles.
+        x_profile (str): The admin profiling token, sent as the X-Profile header.
+
+    Returns:
+        FileResponse: The pstats file of the capture.
+
+    Raises:
+        HTTPException: If the token is missing or invalid, or if the capture does not exist.
+    '''
+    if not _is_admin(_header_bytes(x_profile)):
+        raise HTTPException(status_code=403, detail="Not authorized.")
+
+    capture_path = os.path.join(PROFILE_DIR, f"{os.path.basename(capture_id)}.prof")
+    if not os.path.exists(capture_path):
+        raise HTTPException(status_code=404, detail=f"Profile capture '{capture_id}' not found.")
+
+    return FileResponse(capture_path, media_type="application/octet-stream", filename=f"{capture_id}.prof")
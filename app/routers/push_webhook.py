@@ -0,0 +1,368 @@
+'''
+This module refreshes modules when their repository is pushed to. POST /webhooks/push accepts GitHub style push
+webhooks signed with PUSH_WEBHOOK_SECRET (X-Hub-Signature-256: sha256=<HMAC-SHA256 of the body>) and queues a refresh
+of the module whose module_url matches the pushed repository.
+
+Refreshes are debounced per module: a refresh runs PUSH_REFRESH_DEBOUNCE seconds after the last push, but at the latest
+PUSH_REFRESH_MAX_DELAY seconds after the first one, so a burst of pushes results in a single fetch. Pushes arriving
+while a refresh runs queue exactly one more refresh.
+
+A refresh fetches the repository and only touches the version folders changed between the old and the new commit:
+their files are checked out, line endings are normalized and their checksum is regenerated. Other version folders are
+left as they are. Afterwards the indexes of the module are refreshed and the default archive and file manifest of every
+changed version are built, so the first download after a push does not pay for them.
+
+To test locally, upload a module whose module_url is the path of a local bare repository, push to it and send a
+payload signed with `python -m routers.push_webhook payload.json` (run from the app folder).
+'''
+
+import os
+import hmac
+import json
+import time
+import shutil
+import asyncio
+import hashlib
+import contextvars
+import logging
+import subprocess
+from typing import Optional
+from pymongo import ASCENDING, UpdateOne
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+from database import get_database
+from .archive_utils import negotiate_archive_format, resolve_level, get_archive
+from .change_feed import record_change
+from .checksum_utils import store_checksum
+from .file_manifest import manifest_cache
+from .integrity_scrubber import integrity_scrubber
+from .metrics import register_metrics
+from .normalize_line_endings import normalize_module_line_endings
+from .version_index import version_index
+from .webui_routes import refresh_module_indexes, module_lock, normalize_repo_url
+
+router = APIRouter()
+logger = logging.getLogger(__name__)
+
+BASE_DIR = "c_cpp_modules"
+
+PUSH_WEBHOOK_SECRET = os.getenv("PUSH_WEBHOOK_SECRET", "")
+PUSH_WEBHOOK_MAX_BODY_BYTES = int(os.getenv("PUSH_WEBHOOK_MAX_BODY_BYTES", 5 * 1024 * 1024))
+PUSH_REFRESH_DEBOUNCE = float(os.getenv("PUSH_REFRESH_DEBOUNCE", 10))
+PUSH_REFRESH_MAX_DELAY = float(os.getenv("PUSH_REFRESH_MAX_DELAY", 60))
+PUSH_REFRESH_CONCURRENCY = int(os.getenv("PUSH_REFRESH_CONCURRENCY", 2))
+PUSH_GIT_TIMEOUT = float(os.getenv("PUSH_GIT_TIMEOUT", 120))
+
+
+def sign_payload(body: bytes, secret: str) -> str:
+    '''
+    Returns the X-Hub-Signature-256 header value of a webhook body.
+    '''
+    return "sha256=" + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+def _git(module_folder: str, *args: str, input: str = None) -> str:
+    result = subprocess.run(["git", "-C", module_folder, *args], input=input, capture_output=True, text=True, check=True, timeout=PUSH_GIT_TIMEOUT)
+    return result.stdout
+
+
+def sync_module_repository(module_folder: str) -> tuple[list[str], list[str]]:
+    '''
+    Fetches the upstream branch of a module repository and applies only the changes between the checked out and the
+    fetched commit, then re-normalizes and re-hashes the changed version folders. This is blocking.
+
+    Unlike `git pull` this does not touch unchanged files, whose line endings were normalized at upload and would
+    otherwise make the pull fail or be reverted.
+
+    Args:
+        module_folder (str): The path of the cloned module repository.
+
+    Returns:
+        tuple: (changed or new version folders, removed version folders). Both are empty if nothing changed.
+
+    Raises:
+        subprocess.CalledProcessError: If a git command fails.
+        subprocess.TimeoutExpired: If a git command takes longer than PUSH_GIT_TIMEOUT.
+    '''
+    old_commit = _git(module_folder, "rev-parse", "HEAD").strip()
+    _git(module_folder, "fetch", "--quiet", "origin")
+    new_commit = _git(module_folder, "rev-parse", "@{u}").strip()
+    if old_commit == new_commit:
+        return [], []
+
+    # -z: NUL separated "status\0path\0" pairs, paths are not quoted
+    fields = _git(module_folder, "diff", "--name-status", "-z", "--no-renames", old_commit, new_commit).split("\0")
+    changed_paths, deleted_paths = [], []
+    for status, path in zip(fields[0::2], fields[1::2]):
+        (deleted_paths if status == "D" else changed_paths).append(path)
+
+    _git(module_folder, "reset", "--quiet", "--soft", new_commit)
+    if changed_paths:
+        _git(module_folder, "checkout", "--force", new_commit, "--pathspec-from-file=-", "--pathspec-file-nul", input="\0".join(changed_paths))
+    for path in deleted_paths:
+        try:
+            os.remove(os.path.join(module_folder, path))
+        except FileNotFoundError:
+            pass
+
+    changed_versions, removed_versions = [], []
+    for version in sorted({path.split("/", 1)[0] for path in changed_paths + deleted_paths if "/" in path}):
+        version_path = os.path.join(module_folder, version)
+        if version == ".git" or not os.path.isdir(version_path):
+            continue
+
+        remaining = [name for _, _, files in os.walk(version_path) for name in files if name != "checksum.txt"]
+        if not remaining:
+            shutil.rmtree(version_path)
+            removed_versions.append(version)
+            continue
+
+        normalize_module_line_endings(version_path)
+        checksum_file = os.path.join(version_path, "checksum.txt")
+        if os.path.exists(checksum_file):
+            os.remove(checksum_file)
+        store_checksum(version_path)
+        changed_versions.append(version)
+
+    return changed_versions, removed_versions
+
+
+class PushRefreshQueue:
+    '''
+    Debounces and coalesces refreshes per module and limits how many run at once.
+    '''
+
+    def __init__(self):
+        # module -> {"first_push", "last_push", "pushes"} of pushes not picked up by a refresh yet
+        self._pending: dict[str, dict] = {}
+        self._tasks: dict[str, asyncio.Task] = {}
+        self._semaphore = asyncio.Semaphore(PUSH_REFRESH_CONCURRENCY)
+
+        self.pushes_received = 0
+        self.pushes_coalesced = 0
+        self.refreshes = 0
+        self.failed_refreshes = 0
+        self.versions_ingested = 0
+        self.versions_removed = 0
+        self.last_refresh_at = None
+
+    def enqueue(self, module_name: str, module_url: Optional[str] = None) -> int:
+        '''
+        Records a push and schedules a refresh of the module if none is scheduled yet. The module_url is recorded in
+        the change feed event of the refresh.
+
+        Returns:
+            int: The number of pushes the next refresh of the module will cover.
+        '''
+        now = time.monotonic()
+        state = self._pending.setdefault(module_name, {"first_push": now, "last_push": now, "pushes": 0})
+        state["last_push"] = now
+        state["pushes"] += 1
+        state["module_url"] = module_url
+        self.pushes_received += 1
+
+        if module_name not in self._tasks:
+            # Not tied to the request id of the push which happened to schedule it
+            self._tasks[module_name] = asyncio.create_task(self._worker(module_name), context=contextvars.Context())
+        return state["pushes"]
+
+    async def _worker(self, module_name: str) -> None:
+        try:
+            while (state := self._pending.get(module_name)) is not None:
+                delay = min(state["last_push"] + PUSH_REFRESH_DEBOUNCE, state["first_push"] + PUSH_REFRESH_MAX_DELAY) - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+
+                # Pushes arriving from here on are covered by the next refresh
+                del self._pending[module_name]
+                self.pushes_coalesced += state["pushes"] - 1
+                async with self._semaphore:
+                    try:
+                        await self.refresh(module_name, state.get("module_url"))
+                    except Exception:
+                        # Keeps the worker alive for the pushes queued meanwhile
+                        self.failed_refreshes += 1
+                        logger.exception("Module refresh failed", extra={"module_name": module_name})
+        finally:
+            self._tasks.pop(module_name, None)
+
+    async def refresh(self, module_name: str, module_url: Optional[str] = None) -> None:
+        '''
+        Ingests the changed versions of a module and pre-warms its caches. Errors are logged and counted.
+        Holds the lock of the module, so it does not run at the same time as an update from the Web UI.
+        '''
+        module_folder = os.path.join(BASE_DIR, module_name)
+        started_at = time.perf_counter()
+        async with module_lock(module_name):
+            try:
+                changed_versions, removed_versions = await run_in_threadpool(sync_module_repository, module_folder)
+            except subprocess.CalledProcessError as e:
+                self.failed_refreshes += 1
+                logger.error("Module refresh failed", extra={"module_name": module_name, "command": e.cmd[3:], "stderr": (e.stderr or "").strip()})
+                return
+            except (subprocess.TimeoutExpired, OSError):
+                self.failed_refreshes += 1
+                logger.exception("Module refresh failed", extra={"module_name": module_name})
+                return
+
+            self.refreshes += 1
+            self.last_refresh_at = time.time()
+            if not changed_versions and not removed_versions:
+                return
+
+            try:
+                await run_in_threadpool(integrity_scrubber.release, module_name, changed_versions + removed_versions)
+                await refresh_module_indexes(module_name)
+            except Exception:
+                self.failed_refreshes += 1
+                logger.exception("Error indexing refreshed module", extra={"module_name": module_name})
+                indexed = False
+            else:
+                indexed = True
+
+        # The files have changed either way, so mirrors are told even if indexing failed
+        await record_change("update", module_name, module_url)
+        if not indexed:
+            return
+
+        try:
+            await self._prewarm(module_name, changed_versions)
+        except Exception:
+            logger.exception("Error pre-warming caches", extra={"module_name": module_name})
+
+        self.versions_ingested += len(changed_versions)
+        self.versions_removed += len(removed_versions)
+        logger.info("Module refreshed", extra={
+            "module_name": module_name,
+            "changed_versions": changed_versions,
+            "removed_versions": removed_versions,
+            "duration_ms": round((time.perf_counter() - started_at) * 1000, 2),
+        })
+
+    async def _prewarm(self, module_name: str, versions: list[str]) -> None:
+        archive_format = negotiate_archive_format(None, None)
+        level = resolve_level(archive_format, None)
+        published = set(version_index.sorted_versions(module_name) or [])
+        for version in versions:
+            if version not in published:
+                continue
+            version_dir = os.path.join(BASE_DIR, module_name, version)
+            try:
+                await manifest_cache.get(module_name, version, version_dir)
+                await get_archive(module_name, version, version_dir, archive_format, level)
+            except OSError:
+                logger.exception("Error pre-warming caches", extra={"module_name": module_name, "version": version})
+
+    async def start(self) -> None:
+        '''
+        Indexes the normalized repository URL of the modules, filling it in for modules uploaded before it was stored.
+        '''
+        # Recreated per start, see DownloadStats.start()
+        self._semaphore = asyncio.Semaphore(PUSH_REFRESH_CONCURRENCY)
+
+        collection = get_database()["modules"]
+        try:
+            await collection.create_index([("module_url_normalized", ASCENDING)])
+            updates = [
+                UpdateOne({"_id": module["_id"]}, {"$set": {"module_url_normalized": normalize_repo_url(module.get("module_url") or "")}})
+                async for module in collection.find({"module_url_normalized": {"$exists": False}}, {"module_url": 1})
+            ]
+            if updates:
+                await collection.bulk_write(updates, ordered=False)
+                logger.info("Stored normalized repository URLs", extra={"modules": len(updates)})
+        except Exception:
+            logger.exception("Error preparing the module repository URL index")
+
+    async def stop(self) -> None:
+        '''
+        Cancels scheduled and running refreshes. Pending pushes are dropped, the next push of the module fetches them.
+        '''
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._pending.clear()
+
+    def stats(self) -> dict:
+        return {
+            "enabled": bool(PUSH_WEBHOOK_SECRET),
+            "pending_modules": sorted(self._pending),
+            "running_or_scheduled": len(self._tasks),
+            "pushes_received": self.pushes_received,
+            "pushes_coalesced": self.pushes_coalesced,
+            "refreshes": self.refreshes,
+            "failed_refreshes": self.failed_refreshes,
+            "versions_ingested": self.versions_ingested,
+            "versions_removed": self.versions_removed,
+            "last_refresh_at": self.last_refresh_at,
+        }
+
+
+push_refresh_queue = PushRefreshQueue()
+register_metrics("push_refresh", push_refresh_queue.stats)
+
+
+@router.post("/webhooks/push")
+async def push_webhook(request: Request):
+    '''
+    Receives a push webhook and queues a refresh of the pushed module.
+
+    Args:
+        request (Request): The request object, with the signed JSON payload as body.
+
+    Returns:
+        JSONResponse: 202 with the queued module, or 200 if the event is ignored (ping, other events, other branches).
+
+    Raises:
+        HTTPException: 503 if no secret is configured, 413 if the body is too large, 401 if the signature is invalid,
+                       400 if the payload is not valid JSON and 404 if no module matches the repository.
+    '''
+    if not PUSH_WEBHOOK_SECRET:
+        raise HTTPException(status_code=503, detail="Push webhooks are not configured.")
+
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > PUSH_WEBHOOK_MAX_BODY_BYTES:
+        raise HTTPException(status_code=413, detail=f"Payload exceeds {PUSH_WEBHOOK_MAX_BODY_BYTES} bytes.")
+    body = await request.body()
+    if len(body) > PUSH_WEBHOOK_MAX_BODY_BYTES:
+        raise HTTPException(status_code=413, detail=f"Payload exceeds {PUSH_WEBHOOK_MAX_BODY_BYTES} bytes.")
+
+    # Compared as bytes, compare_digest raises TypeError for str values with non-ASCII characters
+    signature = request.headers.get("x-hub-signature-256", "")
+    if not hmac.compare_digest(signature.encode("latin-1", "replace"), sign_payload(body, PUSH_WEBHOOK_SECRET).encode()):
+        raise HTTPException(status_code=401, detail="Invalid signature.")
+
+    event = request.headers.get("x-github-event", "push")
+    if event == "ping":
+        return JSONResponse(content={"status": "pong"})
+    if event != "push":
+        return JSONResponse(content={"status": "ignored", "reason": f"event '{event}'"})
+
+    try:
+        payload = json.loads(body)
+        repository = payload["repository"]
+    except (json.JSONDecodeError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid push payload.")
+
+    if payload.get("deleted"):
+        return JSONResponse(content={"status": "ignored", "reason": "branch deleted"})
+    default_branch = repository.get("default_branch")
+    if default_branch and payload.get("ref") and payload["ref"] != f"refs/heads/{default_branch}":
+        return JSONResponse(content={"status": "ignored", "reason": f"push to {payload['ref']}"})
+
+    repo_urls = {normalize_repo_url(repository[key]) for key in ("html_url", "clone_url", "ssh_url", "git_url", "url") if isinstance(repository.get(key), str)}
+    module = await get_database()["modules"].find_one({"module_url_normalized": {"$in": list(repo_urls)}}, {"module_name": 1, "module_url": 1})
+    if module is None:
+        raise HTTPException(status_code=404, detail="No module is registered for this repository.")
+
+    pushes = push_refresh_queue.enqueue(module["module_name"], module.get("module_url"))
+    return JSONResponse(status_code=202, content={"status": "queued", "module": module["module_name"], "pending_pushes": pushes})
+
+
+if __name__ == "__main__":
+    import sys
+    # Prints the signature header of a payload file, e.g. for curl -H "X-Hub-Signature-256: ..." --data-binary @payload.json
+    with open(sys.argv[1], "rb") as f:
+        print(f"X-Hub-Signature-256: {sign_payload(f.read(), PUSH_WEBHOOK_SECRET)}")
@@ -0,0 +1,138 @@
+'''
+This module caches complete responses of read-only routes whose output only depends on the content of a module, like
+the rendered /info/{module}/{version} page and the /get_versions JSON. Entries are keyed by route, parameters and a
+digest of the content they were built from, so a changed version never hits an old entry even if it was changed by
+another worker. Entries of a module are additionally dropped when it is uploaded, updated or deleted by this process.
+
+The cache is an LRU limited to RESPONSE_CACHE_MAX_BYTES of response bodies. Concurrent misses of the same key are
+coalesced: the first request builds the response and the others wait for it. Hits, misses and coalesced requests are
+counted per route and reported by /metrics.
+'''
+
+import os
+import asyncio
+import logging
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional
+from starlette.responses import Response
+from .metrics import register_metrics
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+# Larger responses are served but not cached, so a single entry cannot flush the cache
+RESPONSE_CACHE_MAX_ENTRY_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRY_BYTES", 1024 * 1024))
+
+
+@dataclass(frozen=True)
+class CachedResponse:
+    body: bytes
+    status_code: int
+    media_type: Optional[str]
+
+    def to_response(self, cache_status: str) -> Response:
+        return Response(self.body, status_code=self.status_code, media_type=self.media_type, headers={"X-Cache": cache_status})
+
+
+class ResponseCache:
+    def __init__(self, max_bytes: int = RESPONSE_CACHE_MAX_BYTES, max_entry_bytes: int = RESPONSE_CACHE_MAX_ENTRY_BYTES):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        # (route, module, params, digest) -> response, least recently used first
+        self._entries: OrderedDict[tuple, CachedResponse] = OrderedDict()
+        self._in_flight: dict[tuple, asyncio.Future] = {}
+        self.size = 0
+        self._route_stats = defaultdict(lambda: {"hits": 0, "misses": 0, "coalesced": 0})
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _store(self, key: tuple, cached: CachedResponse) -> None:
+        if len(cached.body) > self.max_entry_bytes:
+            return
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.size -= len(previous.body)
+        self._entries[key] = cached
+        self.size += len(cached.body)
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted.body)
+            self.evictions += 1
+
+    async def get_or_compute(self, route: str, module_name: str, params: tuple, digest: str, compute: Callable[[], Awaitable[Response]]) -> Response:
+        '''
+        Returns the cached response of a route, building it with `compute` on a miss. Only 200 responses are cached;
+        exceptions raised by `compute` are raised to every coalesced request.
+
+        Args:
+            route (str): The name of the route, used in the key and for the stats.
+            module_name (str): The module the response belongs to, used for invalidation.
+            params (tuple): The other parameters the response depends on.
+            digest (str): An identifier of the content the response is built from.
+            compute (Callable[[], Awaitable[Response]]): Builds the response on a miss.
+
+        Returns:
+            Response: The response, with an X-Cache header of HIT, MISS or COALESCED.
+        '''
+        key = (route, module_name, params, digest)
+        stats = self._route_stats[route]
+
+        cached = self._entries.get(key)
+        if cached is not None:
+            self._entries.move_to_end(key)
+            stats["hits"] += 1
+            return cached.to_response("HIT")
+
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            stats["coalesced"] += 1
+            return (await asyncio.shield(in_flight)).to_response("COALESCED")
+
+        stats["misses"] += 1
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            response = await compute()
+            cached = CachedResponse(bytes(response.body), response.status_code, response.media_type)
+            if response.status_code == 200:
+                self._store(key, cached)
+            future.set_result(cached)
+        except Exception as e:
+            future.set_exception(e)
+            # Retrieved here so that a failure without waiters is not reported as never retrieved
+            future.exception()
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        finally:
+            self._in_flight.pop(key, None)
+        return cached.to_response("MISS")
+
+    def invalidate_module(self, module_name: str) -> None:
+        '''
+        Drops every cached response of a module.
+        '''
+        for key in [key for key in self._entries if key[1] == module_name]:
+            self.size -= len(self._entries.pop(key).body)
+            self.invalidations += 1
+
+    def stats(self) -> dict:
+        routes = {}
+        for route, counts in self._route_stats.items():
+            lookups = counts["hits"] + counts["misses"] + counts["coalesced"]
+            routes[route] = {**counts, "hit_rate": round((counts["hits"] + counts["coalesced"]) / lookups, 4) if lookups else None}
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "in_flight": len(self._in_flight),
+            "routes": routes,
+        }
+
+
+response_cache = ResponseCache()
+register_metrics("response_cache", response_cache.stats)
@@ -0,0 +1,164 @@
+'''
+This module maintains the reverse dependency index ("who depends on me"). Every `requires` entry in the module_info.json
+of every version is stored as an edge in the `dependencies` collection:
+
+    {module_name, version, dependency, dependency_version, generation}
+
+The edges of a module are replaced whenever it is uploaded or updated and removed when it is deleted, so looking up the
+dependents of a module is an indexed query instead of a scan of every module on disk. Results of up to
+REVERSE_DEPS_CACHE_SIZE modules are cached in memory for REVERSE_DEPS_CACHE_TTL seconds and the cache entries of affected
+modules are dropped on every change made by this process.
+'''
+
+import os
+import json
+import time
+import uuid
+import logging
+from collections import OrderedDict
+from typing import Optional
+from pymongo import ASCENDING
+from starlette.concurrency import run_in_threadpool
+from database import get_database
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = "c_cpp_modules"
+
+REVERSE_DEPS_CACHE_TTL = float(os.getenv("REVERSE_DEPS_CACHE_TTL", 60))
+REVERSE_DEPS_CACHE_SIZE = int(os.getenv("REVERSE_DEPS_CACHE_SIZE", 1024))
+
+
+def parse_requirement(requirement: str) -> tuple[str, Optional[str]]:
+    '''
+    Splits a `requires` entry like "module==1.2.0" into the module name and version (None if no version is pinned).
+    '''
+    name, _, version = requirement.partition("==")
+    return name.strip(), version.strip() or None
+
+
+def read_module_edges(module_name: str, base_dir: str = BASE_DIR) -> list[dict]:
+    '''
+    Reads the dependency edges of every version of a module from disk. This is blocking.
+    '''
+    module_path = os.path.join(base_dir, module_name)
+    edges = []
+    if not os.path.isdir(module_path):
+        return edges
+
+    for version in sorted(os.listdir(module_path)):
+        module_info_path = os.path.join(module_path, version, "module_info.json")
+        if version == ".git" or not os.path.isfile(module_info_path):
+            continue
+        try:
+            with open(module_info_path, "r") as file:
+                requires = json.load(file).get("requires") or []
+        except (OSError, json.JSONDecodeError):
+            logger.warning("Could not read module_info.json", extra={"module_name": module_name, "version": version})
+            continue
+
+        for requirement in requires:
+            dependency, dependency_version = parse_requirement(str(requirement))
+            if dependency:
+                edges.append({
+                    "module_name": module_name,
+                    "version": version,
+                    "dependency": dependency,
+                    "dependency_version": dependency_version,
+                })
+    return edges
+
+
+class ReverseDependencyIndex:
+    def __init__(self, max_entries: int = REVERSE_DEPS_CACHE_SIZE):
+        self.max_entries = max_entries
+        # dependency -> (cached at, edges), least recently used first. Keyed by names from requests, so it is bounded
+        self._cache: OrderedDict[str, tuple[float, list[dict]]] = OrderedDict()
+
+    async def start(self) -> None:
+        '''
+        Creates the indexes of the dependencies collection. If the collection is empty (first start with this index),
+        it is built once from the modules on disk.
+        '''
+        collection = get_database()["dependencies"]
+        try:
+            await collection.create_index([("dependency", ASCENDING), ("dependency_version", ASCENDING)])
+            await collection.create_index([("module_name", ASCENDING)])
+            if await collection.find_one({}) is None:
+                await self.rebuild()
+        except Exception:
+            logger.exception("Error preparing the reverse dependency index")
+
+    async def rebuild(self) -> None:
+        '''
+        Re-creates the edges of every module on disk.
+        '''
+        if not os.path.isdir(BASE_DIR):
+            return
+        module_names = await run_in_threadpool(lambda: [name for name in os.listdir(BASE_DIR) if os.path.isdir(os.path.join(BASE_DIR, name))])
+        for module_name in module_names:
+            await self.refresh_module(module_name)
+        logger.info("Reverse dependency index built", extra={"modules": len(module_names)})
+
+    def _invalidate(self, dependencies) -> None:
+        for dependency in dependencies:
+            self._cache.pop(dependency, None)
+
+    async def refresh_module(self, module_name: str) -> None:
+        '''
+        Replaces the stored edges of a module with the ones currently on disk.
+        '''
+        edges = await run_in_threadpool(read_module_edges, module_name)
+        collection = get_database()["dependencies"]
+        previous = await collection.distinct("dependency", {"module_name": module_name})
+
+        # The new edges are written before the old ones are removed, so readers never see a module without edges
+        generation = uuid.uuid4().hex
+        if edges:
+            await collection.insert_many([{**edge, "generation": generation} for edge in edges])
+        await collection.delete_many({"module_name": module_name, "generation": {"$ne": generation}})
+
+        self._invalidate(set(previous) | {edge["dependency"] for edge in edges})
+
+    async def remove_module(self, module_name: str) -> None:
+        '''
+        Removes the edges of a deleted module. Edges of other modules pointing to it are kept, they still depend on it.
+        '''
+        collection = get_database()["dependencies"]
+        previous = await collection.distinct("dependency", {"module_name": module_name})
+        await collection.delete_many({"module_name": module_name})
+        self._invalidate(previous)
+
+    async def dependents(self, module_name: str, version: Optional[str] = None) -> list[dict]:
+        '''
+        Returns the module versions depending on a module, optionally only those requiring a specific version of it.
+
+        Args:
+            module_name (str): The name of the module depended on.
+            version (Optional[str]): Only return dependents requiring this version (or not pinning a version).
+
+        Returns:
+            list[dict]: The dependents as {"module", "version", "requires"} sorted by module and version.
+        '''
+        cached = self._cache.get(module_name)
+        if cached and time.monotonic() - cached[0] < REVERSE_DEPS_CACHE_TTL:
+            edges = cached[1]
+            self._cache.move_to_end(module_name)
+        else:
+            self._cache.pop(module_name, None)
+            found = await get_database()["dependencies"].find({"dependency": module_name}, {"_id": 0, "generation": 0}).to_list(None)
+            # While a module is refreshed both generations of its edges may be read
+            unique = {(edge["module_name"], edge["version"], edge["dependency_version"]): edge for edge in found}
+            edges = sorted(unique.values(), key=lambda edge: (edge["module_name"], edge["version"]))
+            self._cache[module_name] = (time.monotonic(), edges)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+        return [
+            {"module": edge["module_name"], "version": edge["version"], "requires": edge["dependency_version"]}
+            for edge in edges
+            if version is None or edge["dependency_version"] in (None, version)
+        ]
+
+
+reverse_dependency_index = ReverseDependencyIndex()
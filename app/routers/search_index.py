@@ -0,0 +1,215 @@
+'''
+This module keeps an in-memory inverted index over the metadata of every module (its name and the author, description
+and license of its latest version from module_info.json). It is built at startup and updated per module on upload,
+update and delete, so searches are ranked with BM25 without touching the disk.
+'''
+
+import os
+import re
+import json
+import math
+import time
+import logging
+from collections import OrderedDict, defaultdict
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = "c_cpp_modules"
+
+# Relative weight of a match in each field
+FIELD_WEIGHTS = {"name": 3.0, "author": 2.0, "description": 1.0, "license": 1.0}
+
+# Modules found missing on disk are not looked up again for this many seconds
+SEARCH_MISS_TTL = float(os.getenv("SEARCH_MISS_TTL", 30))
+MAX_CACHED_MISSES = 10000
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+_STOP_WORDS = {"a", "an", "and", "for", "in", "is", "of", "on", "or", "the", "to", "with"}
+
+
+def tokenize(text: Optional[str]) -> list[str]:
+    '''
+    Lowercases the text and splits it into alphanumeric tokens, so "string_utils-v2" becomes ["string", "utils", "v2"].
+    '''
+    if not text:
+        return []
+    return [token for token in _TOKEN_RE.findall(str(text).lower()) if token not in _STOP_WORDS]
+
+
+class SearchIndex:
+    '''
+    Inverted index of module metadata with BM25 ranking and exact (case-insensitive) license and author filters.
+    '''
+
+    def __init__(self, base_dir: str = BASE_DIR):
+        self.base_dir = base_dir
+        self.documents: dict[str, dict] = {}
+        # field -> term -> module -> term frequency
+        self._postings: dict[str, dict[str, dict[str, int]]] = {field: defaultdict(dict) for field in FIELD_WEIGHTS}
+        # field -> module -> number of tokens
+        self._lengths: dict[str, dict[str, int]] = {field: {} for field in FIELD_WEIGHTS}
+        self._total_lengths: dict[str, int] = {field: 0 for field in FIELD_WEIGHTS}
+        # filter -> lowercased value -> modules
+        self._filters: dict[str, dict[str, set]] = {"license": defaultdict(set), "author": defaultdict(set)}
+        # module -> time it was found missing, oldest first
+        self._misses: OrderedDict[str, float] = OrderedDict()
+
+    def _read_metadata(self, module_name: str) -> Optional[dict]:
+        try:
+            with open(os.path.join(self.base_dir, module_name, "versions.json"), "r") as file:
+                versions = json.load(file)
+            with open(os.path.join(self.base_dir, versions["latest_path"], "module_info.json"), "r") as file:
+                module_info = json.load(file)
+        except FileNotFoundError:
+            return None
+        except (OSError, KeyError, TypeError, json.JSONDecodeError):
+            logger.warning("Could not read module metadata", extra={"module_name": module_name})
+            return None
+
+        return {
+            "module": module_name,
+            "latest": versions.get("latest"),
+            "author": module_info.get("author"),
+            "description": module_info.get("description"),
+            "license": module_info.get("license"),
+        }
+
+    def remove_module(self, module_name: str) -> None:
+        document = self.documents.pop(module_name, None)
+        if document is None:
+            return
+
+        for field in FIELD_WEIGHTS:
+            for term in set(document["_tokens"][field]):
+                postings = self._postings[field].get(term)
+                if postings is not None:
+                    postings.pop(module_name, None)
+                    if not postings:
+                        del self._postings[field][term]
+            self._total_lengths[field] -= self._lengths[field].pop(module_name, 0)
+
+        for filter_name in self._filters:
+            value = (document.get(filter_name) or "").lower()
+            modules = self._filters[filter_name].get(value)
+            if modules is not None:
+                modules.discard(module_name)
+                if not modules:
+                    del self._filters[filter_name][value]
+
+    def refresh_module(self, module_name: str) -> None:
+        '''
+        Re-indexes a module from the module_info.json of its latest version, dropping it if it no longer exists.
+        '''
+        self.remove_module(module_name)
+        self._misses.pop(module_name, None)
+        document = self._read_metadata(module_name)
+        if document is None:
+            return
+
+        tokens = {
+            "name": tokenize(module_name),
+            "author": tokenize(document["author"]),
+            "description": tokenize(document["description"]),
+            "license": tokenize(document["license"]),
+        }
+        document["_tokens"] = tokens
+        self.documents[module_name] = document
+
+        for field, field_tokens in tokens.items():
+            for term in field_tokens:
+                postings = self._postings[field][term]
+                postings[module_name] = postings.get(module_name, 0) + 1
+            self._lengths[field][module_name] = len(field_tokens)
+            self._total_lengths[field] += len(field_tokens)
+
+        for filter_name in self._filters:
+            if document.get(filter_name):
+                self._filters[filter_name][str(document[filter_name]).lower()].add(module_name)
+
+    def load_all(self) -> None:
+        '''
+        Builds the index for every module in the base directory. This is blocking.
+        '''
+        if not os.path.isdir(self.base_dir):
+            return
+        for module_name in os.listdir(self.base_dir):
+            if os.path.isdir(os.path.join(self.base_dir, module_name)):
+                self.refresh_module(module_name)
+        logger.info("Search index built", extra={"modules": len(self.documents)})
+
+    def get_metadata(self, module_name: str) -> Optional[dict]:
+        '''
+        Returns the indexed metadata (latest version, author, description, license) of a module, or None if it does not
+        exist. Modules not indexed yet, e.g. uploaded by another worker, are read from disk once. Misses are remembered
+        for SEARCH_MISS_TTL seconds, so repeated lookups of unknown names do not read the disk every time.
+        '''
+        if module_name not in self.documents:
+            missed_at = self._misses.get(module_name)
+            if missed_at is not None and time.monotonic() - missed_at < SEARCH_MISS_TTL:
+                return None
+            self.refresh_module(module_name)
+            if module_name not in self.documents:
+                self._misses[module_name] = time.monotonic()
+                if len(self._misses) > MAX_CACHED_MISSES:
+                    self._misses.popitem(last=False)
+                return None
+        return self._result(module_name, None)
+
+    def search(self, query: str = "", license: Optional[str] = None, author: Optional[str] = None, offset: int = 0, limit: int = 20) -> tuple[int, list[dict]]:
+        '''
+        Searches the indexed modules.
+
+        Args:
+            query (str): Free text, matched against name, author, description and license. Without a query all modules
+                         passing the filters are returned in alphabetical order.
+            license (Optional[str]): Only return modules with exactly this license (case-insensitive).
+            author (Optional[str]): Only return modules with exactly this author (case-insensitive).
+            offset (int): Number of results to skip.
+            limit (int): Maximum number of results to return.
+
+        Returns:
+            tuple: (total number of results, the requested page of results with their scores).
+        '''
+        candidates = None
+        for filter_name, value in (("license", license), ("author", author)):
+            if value:
+                modules = self._filters[filter_name].get(value.lower(), set())
+                candidates = modules if candidates is None else candidates & modules
+
+        terms = tokenize(query)
+        if not terms:
+            names = sorted(self.documents if candidates is None else candidates)
+            return len(names), [self._result(name, None) for name in names[offset:offset + limit]]
+
+        document_count = len(self.documents)
+        scores = defaultdict(float)
+        for field, weight in FIELD_WEIGHTS.items():
+            average_length = self._total_lengths[field] / document_count if document_count else 0
+            for term in set(terms):
+                postings = self._postings[field].get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (document_count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for module_name, frequency in postings.items():
+                    if candidates is not None and module_name not in candidates:
+                        continue
+                    length = self._lengths[field][module_name]
+                    norm = 1 - BM25_B + BM25_B * (length / average_length if average_length else 0)
+                    scores[module_name] += weight * idf * frequency * (BM25_K1 + 1) / (frequency + BM25_K1 * norm)
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return len(ranked), [self._result(name, score) for name, score in ranked[offset:offset + limit]]
+
+    def _result(self, module_name: str, score: Optional[float]) -> dict:
+        document = self.documents[module_name]
+        result = {key: value for key, value in document.items() if not key.startswith("_")}
+        if score is not None:
+            result["score"] = round(score, 4)
+        return result
+
+
+search_index = SearchIndex()
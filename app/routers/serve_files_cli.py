@@ -1,24 +1,41 @@
+import io
 import os
 import json
-import io
+import hashlib
+import logging
 import zipfile
-from fastapi import APIRouter, HTTPException
-from fastapi.responses import StreamingResponse
+from typing import Optional
+from fastapi import APIRouter, HTTPException, Depends, Request, Query
+from fastapi.responses import FileResponse, Response
+from starlette.concurrency import run_in_threadpool
+from .admission_control import admission
+from .archive_utils import negotiate_archive_format, resolve_level, get_archive, is_safe_path_segment
+from .file_manifest import manifest_cache
+from .download_stats import download_stats
+from .integrity_scrubber import integrity_scrubber
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
 
 BASE_DIR = 'c_cpp_modules'
 
-@router.get("/files/{module_name}")
-async def serve_latest_version(module_name: str):
+# Limits of a batch raw file request
+RAW_BATCH_MAX_FILES = int(os.getenv("RAW_BATCH_MAX_FILES", 64))
+RAW_BATCH_MAX_BYTES = int(os.getenv("RAW_BATCH_MAX_BYTES", 8 * 1024 * 1024))
+
+@router.get("/files/{module_name}", dependencies=[Depends(admission("archive"))])
+async def serve_latest_version(request: Request, module_name: str, archive_format: Optional[str] = Query(None, alias="format"), level: Optional[int] = None):
     '''
     This function serves the latest version of the specified module.
 
     Args:
+        request (Request): The request object, its Accept header is used to select the archive format.
         module_name (str): The name of the module.
+        archive_format (Optional[str]): The archive format (zip, zip-deflate, tar.gz or tar.zst), overrides the Accept header.
+        level (Optional[int]): The compression level, defaults to the configured level of the format.
 
     Returns:
-        StreamingResponse: A StreamingResponse object containing the zipped module files.
+        FileResponse: A FileResponse object containing the archived module files.
 
     Raises:
         HTTPException: If the module directory does not exist.
@@ -26,6 +43,8 @@ async def serve_latest_version(module_name: str):
         Exception: If an error occurs while serving the files.
     '''
     versions_file_path = os.path.join(BASE_DIR, module_name, 'versions.json')
+    selected_format = negotiate_archive_format(archive_format, request.headers.get("accept"))
+    selected_level = resolve_level(selected_format, level)
     
     if not os.path.exists(os.path.join(BASE_DIR, module_name)):
         raise HTTPException(status_code=404, detail=f"Module '{module_name}' not found.")
@@ -39,43 +58,49 @@ async def serve_latest_version(module_name: str):
             latest_path = data.get('latest_path')
             version = data.get('latest')
 
+            if not is_safe_path_segment(version):
+                raise HTTPException(status_code=500, detail="The 'latest' key in the versions.json file is missing or invalid.")
+
             if latest_path:
                 module_dir = os.path.join(BASE_DIR, latest_path)
 
                 if not os.path.exists(module_dir):
                     raise HTTPException(status_code=404, detail=f"The latest module path '{latest_path}' does not exist.")
 
-                zip_stream = io.BytesIO()
-                with zipfile.ZipFile(zip_stream, 'w') as zipf:
-                    for root, dirs, files in os.walk(module_dir):
-                        for file in files:
-                            file_path = os.path.join(root, file)
-                            zipf.write(file_path, os.path.relpath(file_path, module_dir))
+                if integrity_scrubber.is_quarantined(module_name, version):
+                    raise HTTPException(status_code=503, detail=f"Version {version} of '{module_name}' failed its integrity check and is unavailable.")
 
-                zip_stream.seek(0)
-                return StreamingResponse(zip_stream, media_type="application/zip", headers={
-                    "Content-Disposition": f"attachment; filename={module_name}_{version}.zip"
+                archive_path = await get_archive(module_name, version, module_dir, selected_format, selected_level)
+                download_stats.record(module_name, version)
+                return FileResponse(archive_path, media_type=selected_format.media_type, headers={
+                    "Content-Disposition": f"attachment; filename={module_name}_{version}{selected_format.extension}",
+                    "Vary": "Accept"
                 })
             else:
                 raise HTTPException(status_code=500, detail="The 'latest_path' key is missing in the versions.json file.")
+    except HTTPException:
+        raise
     except json.JSONDecodeError:
         raise HTTPException(status_code=500, detail="Error decoding the versions.json file.")
-    except Exception as e:
-        print(f"An error occurred: {e}")
+    except Exception:
+        logger.exception("Error serving latest version", extra={"module_name": module_name})
         raise HTTPException(status_code=500, detail="An error occurred.")
 
 
-@router.get("/files/{module_name}/{version}")
-async def serve_specified_version(module_name: str, version: str):
+@router.get("/files/{module_name}/{version}", dependencies=[Depends(admission("archive"))])
+async def serve_specified_version(request: Request, module_name: str, version: str, archive_format: Optional[str] = Query(None, alias="format"), level: Optional[int] = None):
     '''
     This function serves the specified version of the specified module.
 
     Args:
+        request (Request): The request object, its Accept header is used to select the archive format.
         module_name (str): The name of the module.
         version (str): The version of the module.
+        archive_format (Optional[str]): The archive format (zip, zip-deflate, tar.gz or tar.zst), overrides the Accept header.
+        level (Optional[int]): The compression level, defaults to the configured level of the format.
 
     Returns:
-        StreamingResponse: A StreamingResponse object containing the zipped module files.
+        FileResponse: A FileResponse object containing the archived module files.
 
     Raises:
         HTTPException: If the module directory does not exist.
@@ -83,25 +108,163 @@ async def serve_specified_version(module_name: str, version: str):
     '''
     module_dir = os.path.join(BASE_DIR, module_name, version)
     module_dir_wo_version = os.path.join(BASE_DIR, module_name)
+    selected_format = negotiate_archive_format(archive_format, request.headers.get("accept"))
+    selected_level = resolve_level(selected_format, level)
     
     if not os.path.exists(module_dir_wo_version):
         raise HTTPException(status_code=404, detail=f"Module '{module_name}' not found.")
     
-    if not os.path.exists(module_dir):
+    if not is_safe_path_segment(version) or not os.path.exists(module_dir):
         raise HTTPException(status_code=404, detail=f"Module '{module_name}' with version {version} not found.")
 
+    if integrity_scrubber.is_quarantined(module_name, version):
+        raise HTTPException(status_code=503, detail=f"Version {version} of '{module_name}' failed its integrity check and is unavailable.")
+
     try:
-        zip_stream = io.BytesIO()
-        with zipfile.ZipFile(zip_stream, 'w') as zipf:
-            for root, dirs, files in os.walk(module_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    zipf.write(file_path, os.path.relpath(file_path, module_dir))
-        
-        zip_stream.seek(0)
-        return StreamingResponse(zip_stream, media_type="application/zip", headers={
-            "Content-Disposition": f"attachment; filename={module_name}_{version}.zip"
+        archive_path = await get_archive(module_name, version, module_dir, selected_format, selected_level)
+        download_stats.record(module_name, version)
+        return FileResponse(archive_path, media_type=selected_format.media_type, headers={
+            "Content-Disposition": f"attachment; filename={module_name}_{version}{selected_format.extension}",
+            "Vary": "Accept"
         })
-    except Exception as e:
-        print(f"Error: {e}")
-        raise HTTPException(status_code=500, detail="Error occurred while serving files.")
\ No newline at end of file
+    except Exception:
+        logger.exception("Error serving version", extra={"module_name": module_name, "version": version})
+        raise HTTPException(status_code=500, detail="Error occurred while serving files.")
+
+
+def _normalize_raw_path(file_path: str) -> str:
+    '''
+    Validates a file path relative to a version folder. Absolute paths, backslashes and "." or ".." segments are
+    rejected instead of being resolved, so a path can never point outside the version folder.
+    '''
+    parts = file_path.split("/")
+    if not file_path or "\\" in file_path or "\x00" in file_path or any(part in ("", ".", "..") for part in parts):
+        raise HTTPException(status_code=400, detail=f"Invalid file path '{file_path}'.")
+    return "/".join(parts)
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    return if_none_match.strip() == "*" or etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+
+async def _get_version_manifest(module_name: str, version: str) -> tuple[str, dict]:
+    module_dir = os.path.join(BASE_DIR, module_name, version)
+
+    if not os.path.exists(os.path.join(BASE_DIR, module_name)):
+        raise HTTPException(status_code=404, detail=f"Module '{module_name}' not found.")
+
+    if version == ".git" or not os.path.isdir(module_dir):
+        raise HTTPException(status_code=404, detail=f"Module '{module_name}' with version {version} not found.")
+
+    if integrity_scrubber.is_quarantined(module_name, version):
+        raise HTTPException(status_code=503, detail=f"Version {version} of '{module_name}' failed its integrity check and is unavailable.")
+
+    return module_dir, await manifest_cache.get(module_name, version, module_dir)
+
+
+def _resolve_raw_file(module_dir: str, manifest: dict, file_path: str) -> str:
+    '''
+    Returns the path on disk of a file listed in the manifest. Symlinks resolving outside the version folder are treated
+    as missing.
+    '''
+    relative_path = _normalize_raw_path(file_path)
+    if relative_path not in manifest:
+        raise HTTPException(status_code=404, detail=f"File '{file_path}' not found.")
+
+    real_module_dir = os.path.realpath(module_dir)
+    real_path = os.path.realpath(os.path.join(module_dir, relative_path))
+    if not real_path.startswith(real_module_dir + os.sep):
+        raise HTTPException(status_code=404, detail=f"File '{file_path}' not found.")
+    return real_path
+
+
+@router.get("/files/{module_name}/{version}/raw/{file_path:path}", dependencies=[Depends(admission("raw"))])
+async def serve_raw_file(request: Request, module_name: str, version: str, file_path: str):
+    '''
+    This function serves a single file of the specified version of the specified module, e.g. its module_info.json or
+    one header, without building an archive.
+
+    Args:
+        request (Request): The request object, its If-None-Match header is compared with the ETag of the file.
+        module_name (str): The name of the module.
+        version (str): The version of the module.
+        file_path (str): The path of the file relative to the version folder.
+
+    Returns:
+        FileResponse: The file with the SHA-256 of its content as ETag, or an empty 304 response if the ETag matches.
+
+    Raises:
+        HTTPException: 400 if the path is invalid, 404 if the module, version or file does not exist, 503 if the version
+                       is quarantined.
+    '''
+    module_dir, manifest = await _get_version_manifest(module_name, version)
+    real_path = _resolve_raw_file(module_dir, manifest, file_path)
+    entry = manifest[_normalize_raw_path(file_path)]
+
+    if _etag_matches(request, entry.etag):
+        return Response(status_code=304, headers={"ETag": entry.etag})
+
+    try:
+        stat_result = await run_in_threadpool(os.stat, real_path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=f"File '{file_path}' not found.")
+
+    return FileResponse(real_path, stat_result=stat_result, headers={"ETag": entry.etag})
+
+
+def _build_raw_batch(files: list[tuple[str, str]]) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_STORED) as zipf:
+        for real_path, arcname in files:
+            zipf.write(real_path, arcname)
+    return buffer.getvalue()
+
+
+@router.get("/files/{module_name}/{version}/raw", dependencies=[Depends(admission("raw"))])
+async def serve_raw_files(request: Request, module_name: str, version: str, paths: list[str] = Query(..., alias="path")):
+    '''
+    This function serves several files of the specified version of the specified module in one uncompressed zip,
+    e.g. /files/my_module/1.0.0/raw?path=module_info.json&path=include/my_module.h
+
+    Args:
+        request (Request): The request object, its If-None-Match header is compared with the ETag of the batch.
+        module_name (str): The name of the module.
+        version (str): The version of the module.
+        paths (list[str]): The paths of the files relative to the version folder.
+
+    Returns:
+        Response: The zip with an ETag derived from the ETags of the files, or an empty 304 response if it matches.
+
+    Raises:
+        HTTPException: 400 if a path is invalid, 404 if the module, version or a file does not exist, 413 if the batch
+                       exceeds RAW_BATCH_MAX_FILES or RAW_BATCH_MAX_BYTES, 503 if the version is quarantined.
+    '''
+    relative_paths = list(dict.fromkeys(_normalize_raw_path(path) for path in paths))
+    if len(relative_paths) > RAW_BATCH_MAX_FILES:
+        raise HTTPException(status_code=413, detail=f"At most {RAW_BATCH_MAX_FILES} files can be requested at once.")
+
+    module_dir, manifest = await _get_version_manifest(module_name, version)
+    files = [(_resolve_raw_file(module_dir, manifest, path), path) for path in relative_paths]
+    if sum(manifest[path].size for path in relative_paths) > RAW_BATCH_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"The requested files exceed {RAW_BATCH_MAX_BYTES} bytes.")
+
+    batch_hash = hashlib.sha256()
+    for path in relative_paths:
+        batch_hash.update(f"{path}:{manifest[path].sha256}\n".encode())
+    etag = f'"{batch_hash.hexdigest()}"'
+
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    try:
+        content = await run_in_threadpool(_build_raw_batch, files)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="A requested file no longer exists.")
+
+    return Response(content, media_type="application/zip", headers={
+        "Content-Disposition": f"attachment; filename={module_name}_{version}_files.zip",
+        "ETag": etag
+    })
@@ -0,0 +1,327 @@
+'''
+This module keeps an in-memory, semver sorted index of the versions of every module. It is built from the versions.json
+files at startup and refreshed whenever a module is uploaded, updated or deleted, so that version range queries like
+">=1.2,<2", "^1.4" or "1.x" are answered with a binary search instead of reading and sorting versions.json per request.
+
+Supported range syntax (comma separated comparators are intersected):
+    *, 1.x, 1.2.*, 1.2      wildcards / partial versions
+    1.2.3, ==1.2.3, =1.2.3  exact version
+    >=, >, <=, <            comparisons, partial versions are padded with zeros
+    ^1.2.3                  compatible with 1.2.3 (>=1.2.3,<2.0.0; <0.3.0 for 0.2.x)
+    ~1.2.3                  patch updates only (>=1.2.3,<1.3.0)
+
+Pre-release versions (1.2.0-beta.1) only match when explicitly requested.
+'''
+
+import os
+import re
+import json
+import time
+import logging
+from collections import OrderedDict
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass, field
+from typing import Optional
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = "c_cpp_modules"
+
+# Modules found missing on disk are not looked up again for this many seconds
+VERSION_MISS_TTL = float(os.getenv("VERSION_MISS_TTL", 30))
+MAX_CACHED_MISSES = 10000
+
+_VERSION_RE = re.compile(r"^v?(\d+)(?:\.(\d+))?(?:\.(\d+))?(?:-([0-9A-Za-z.-]+))?(?:\+[0-9A-Za-z.-]+)?$")
+_WILDCARDS = ("x", "X", "*")
+
+# Sorts below every pre-release and release of the same major.minor.patch
+_MIN_PRE = (0,)
+_RELEASE = (1,)
+
+
+class InvalidVersionSpec(ValueError):
+    pass
+
+
+def _prerelease_key(prerelease: Optional[str]) -> tuple:
+    if not prerelease:
+        return _RELEASE
+    identifiers = tuple((0, int(part), "") if part.isdigit() else (1, 0, part) for part in prerelease.split("."))
+    return (0,) + identifiers
+
+
+def parse_version(version: str) -> Optional[tuple]:
+    '''
+    Returns the sort key of a semver version string, or None if it is not a valid version.
+    Missing minor and patch numbers are treated as 0.
+    '''
+    match = _VERSION_RE.match(version.strip())
+    if not match:
+        return None
+    major, minor, patch, prerelease = match.groups()
+    return (int(major), int(minor or 0), int(patch or 0), _prerelease_key(prerelease))
+
+
+def _parse_partial(version: str) -> tuple[list[int], Optional[str]]:
+    '''
+    Parses a possibly partial version ("1", "1.2", "1.x", "1.2.3-rc.1") into its given numeric parts and pre-release.
+    '''
+    version = version.strip().lstrip("v")
+    prerelease = None
+    if "-" in version:
+        version, prerelease = version.split("-", 1)
+    version = version.split("+", 1)[0]
+
+    parts = []
+    for part in version.split("."):
+        if part in _WILDCARDS:
+            break
+        if not part.isdigit():
+            raise InvalidVersionSpec(f"Invalid version '{version}'")
+        parts.append(int(part))
+    if len(parts) > 3 or (prerelease and len(parts) != 3):
+        raise InvalidVersionSpec(f"Invalid version '{version}'")
+    return parts, prerelease
+
+
+def _padded_key(parts: list[int], prerelease: Optional[str] = None, pre=None) -> tuple:
+    padded = parts + [0] * (3 - len(parts))
+    return (padded[0], padded[1], padded[2], pre if pre is not None else _prerelease_key(prerelease))
+
+
+def _next_key(parts: list[int]) -> tuple:
+    '''
+    The smallest key above every version starting with the given parts, e.g. [1, 2] -> 1.3.0 (below its pre-releases).
+    '''
+    if not parts:
+        return None
+    bumped = parts[:-1] + [parts[-1] + 1]
+    return _padded_key(bumped, pre=_MIN_PRE)
+
+
+def parse_spec(spec: str) -> tuple:
+    '''
+    Parses a version range into a single interval.
+
+    Args:
+        spec (str): The version range, see the module docstring for the syntax.
+
+    Returns:
+        tuple: (lower_key, lower_inclusive, upper_key, upper_inclusive), keys are None when unbounded.
+
+    Raises:
+        InvalidVersionSpec: If the spec cannot be parsed.
+    '''
+    lower, lower_inclusive = None, True
+    upper, upper_inclusive = None, True
+
+    def raise_lower(key, inclusive):
+        nonlocal lower, lower_inclusive
+        if lower is None or key > lower or (key == lower and not inclusive):
+            lower, lower_inclusive = key, inclusive
+
+    def cut_upper(key, inclusive):
+        nonlocal upper, upper_inclusive
+        if upper is None or key < upper or (key == upper and not inclusive):
+            upper, upper_inclusive = key, inclusive
+
+    for comparator in (spec or "*").split(","):
+        comparator = comparator.strip()
+        if comparator in ("", *_WILDCARDS):
+            continue
+
+        operator_match = re.match(r"^(>=|<=|==|=|>|<|\^|~)?\s*(.+)$", comparator)
+        if not operator_match:
+            raise InvalidVersionSpec(f"Invalid range '{comparator}'")
+        operator, version = operator_match.groups()
+        parts, prerelease = _parse_partial(version)
+
+        if operator in (None, "=", "=="):
+            if len(parts) == 3:
+                key = _padded_key(parts, prerelease)
+                raise_lower(key, True)
+                cut_upper(key, True)
+            elif parts:
+                raise_lower(_padded_key(parts, pre=_MIN_PRE), True)
+                cut_upper(_next_key(parts), False)
+        elif operator == ">=":
+            raise_lower(_padded_key(parts, prerelease, pre=None if prerelease or len(parts) == 3 else _MIN_PRE), True)
+        elif operator == ">":
+            if len(parts) == 3:
+                raise_lower(_padded_key(parts, prerelease), False)
+            elif parts:
+                raise_lower(_next_key(parts), True)
+        elif operator == "<=":
+            if len(parts) == 3:
+                cut_upper(_padded_key(parts, prerelease), True)
+            elif parts:
+                cut_upper(_next_key(parts), False)
+        elif operator == "<":
+            cut_upper(_padded_key(parts, prerelease, pre=None if prerelease else _MIN_PRE), False)
+        elif operator == "^":
+            if not parts:
+                raise InvalidVersionSpec(f"Invalid range '{comparator}'")
+            raise_lower(_padded_key(parts, prerelease, pre=None if prerelease or len(parts) == 3 else _MIN_PRE), True)
+            # Bump the left-most non-zero part (or the last given one)
+            significant = next((i for i, part in enumerate(parts) if part != 0), len(parts) - 1)
+            cut_upper(_next_key(parts[:significant + 1]), False)
+        elif operator == "~":
+            if not parts:
+                raise InvalidVersionSpec(f"Invalid range '{comparator}'")
+            raise_lower(_padded_key(parts, prerelease, pre=None if prerelease or len(parts) == 3 else _MIN_PRE), True)
+            cut_upper(_next_key(parts[:2] if len(parts) >= 2 else parts), False)
+
+    return lower, lower_inclusive, upper, upper_inclusive
+
+
+@dataclass
+class ModuleVersions:
+    keys: list = field(default_factory=list)
+    versions: list = field(default_factory=list)
+    release_keys: list = field(default_factory=list)
+    release_versions: list = field(default_factory=list)
+    unparsed_versions: list = field(default_factory=list)
+
+
+class VersionIndex:
+    '''
+    Sorted versions of every module, kept in memory.
+    '''
+
+    def __init__(self, base_dir: str = BASE_DIR):
+        self.base_dir = base_dir
+        self._modules: dict[str, ModuleVersions] = {}
+        # module -> time it was found missing, oldest first
+        self._misses: OrderedDict[str, float] = OrderedDict()
+
+    def _read_versions(self, module_name: str) -> Optional[list[str]]:
+        versions_file_path = os.path.join(self.base_dir, module_name, "versions.json")
+        try:
+            with open(versions_file_path, "r") as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            return None
+        except (OSError, json.JSONDecodeError):
+            logger.warning("Could not read versions.json", extra={"module_name": module_name})
+            return None
+        return [item["version"] for item in data.get("versions", []) if "version" in item]
+
+    def _read_entry(self, module_name: str) -> Optional[ModuleVersions]:
+        '''
+        Reads and sorts the versions of a module, None if it does not exist. This is blocking and does not change the index.
+        Versions that are not valid semver never match a range, they are only kept for listing.
+        '''
+        versions = self._read_versions(module_name)
+        if versions is None:
+            return None
+
+        parsed = sorted((key, version) for version in versions if (key := parse_version(version)) is not None)
+        return ModuleVersions(
+            keys=[key for key, _ in parsed],
+            versions=[version for _, version in parsed],
+            release_keys=[key for key, _ in parsed if key[3] == _RELEASE],
+            release_versions=[version for key, version in parsed if key[3] == _RELEASE],
+            unparsed_versions=[version for version in versions if parse_version(version) is None],
+        )
+
+    def _store(self, module_name: str, entry: Optional[ModuleVersions]) -> None:
+        if entry is not None:
+            self._misses.pop(module_name, None)
+            self._modules[module_name] = entry
+            return
+
+        self._modules.pop(module_name, None)
+        self._misses.pop(module_name, None)
+        self._misses[module_name] = time.monotonic()
+        if len(self._misses) > MAX_CACHED_MISSES:
+            self._misses.popitem(last=False)
+
+    def _is_cached_miss(self, module_name: str) -> bool:
+        missed_at = self._misses.get(module_name)
+        return missed_at is not None and time.monotonic() - missed_at < VERSION_MISS_TTL
+
+    def refresh_module(self, module_name: str) -> None:
+        '''
+        Re-reads the versions of a module from its versions.json, dropping it from the index if it no longer exists.
+        '''
+        self._store(module_name, self._read_entry(module_name))
+
+    async def load(self, module_name: str) -> None:
+        '''
+        Makes sure a module which is not indexed yet, e.g. uploaded by another worker, has been looked up, reading its
+        versions.json in the threadpool. Call it before the synchronous lookups in request handlers. Misses are
+        remembered for VERSION_MISS_TTL seconds.
+        '''
+        if module_name in self._modules or self._is_cached_miss(module_name):
+            return
+        self._store(module_name, await run_in_threadpool(self._read_entry, module_name))
+
+    def remove_module(self, module_name: str) -> None:
+        self._modules.pop(module_name, None)
+        self._misses.pop(module_name, None)
+
+    def load_all(self) -> None:
+        '''
+        Builds the index for every module in the base directory. This is blocking.
+        '''
+        if not os.path.isdir(self.base_dir):
+            return
+        for module_name in os.listdir(self.base_dir):
+            if os.path.isdir(os.path.join(self.base_dir, module_name)):
+                self.refresh_module(module_name)
+        logger.info("Version index built", extra={"modules": len(self._modules)})
+
+    def _get(self, module_name: str) -> Optional[ModuleVersions]:
+        entry = self._modules.get(module_name)
+        if entry is None and not self._is_cached_miss(module_name):
+            # Uploaded by another worker or not indexed yet, callers on the event loop await load() first
+            self.refresh_module(module_name)
+            entry = self._modules.get(module_name)
+        return entry
+
+    def __contains__(self, module_name: str) -> bool:
+        return self._get(module_name) is not None
+
+    def sorted_versions(self, module_name: str, include_prerelease: bool = True) -> Optional[list[str]]:
+        '''
+        Returns the versions of a module from oldest to newest, or None if the module is unknown.
+        Versions that are not valid semver are listed first, in versions.json order.
+        '''
+        entry = self._get(module_name)
+        if entry is None:
+            return None
+        return entry.unparsed_versions + (entry.versions if include_prerelease else entry.release_versions)
+
+    def resolve(self, module_name: str, spec: str, include_prerelease: bool = False) -> Optional[tuple[Optional[str], int]]:
+        '''
+        Finds the newest version of a module satisfying the range.
+
+        Args:
+            module_name (str): The name of the module.
+            spec (str): The version range.
+            include_prerelease (bool): Whether pre-release versions may match.
+
+        Returns:
+            tuple: (newest matching version or None, number of matching versions), or None if the module is unknown.
+
+        Raises:
+            InvalidVersionSpec: If the spec cannot be parsed.
+        '''
+        lower, lower_inclusive, upper, upper_inclusive = parse_spec(spec)
+        entry = self._get(module_name)
+        if entry is None:
+            return None
+
+        keys = entry.keys if include_prerelease else entry.release_keys
+        versions = entry.versions if include_prerelease else entry.release_versions
+
+        start = 0 if lower is None else (bisect_left(keys, lower) if lower_inclusive else bisect_right(keys, lower))
+        end = len(keys) if upper is None else (bisect_right(keys, upper) if upper_inclusive else bisect_left(keys, upper))
+
+        if end <= start:
+            return None, 0
+        return versions[end - 1], end - start
+
+
+version_index = VersionIndex()
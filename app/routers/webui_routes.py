@@ -1,10 +1,15 @@
 import os
-import shutil
 import json
+import asyncio
+import hashlib
+import logging
+from contextlib import asynccontextmanager
 from fastapi import APIRouter, HTTPException, Depends, Request, Form
 from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
 from secrets import token_hex
+from urllib.parse import urlsplit
 from fastapi.templating import Jinja2Templates
+from starlette.concurrency import run_in_threadpool
 from starlette.responses import JSONResponse
 from starlette.middleware.sessions import SessionMiddleware
 from werkzeug.security import check_password_hash, generate_password_hash
@@ -13,23 +18,115 @@ from database import get_database, get_next_sequence_value
 from models import User, Module
 from rapidfuzz import process
 from .checksum_utils import generate_module_checksum, generate_checksums_for_new_versions
-from .normalize_line_endings import normalize_line_endings
+from .normalize_line_endings import normalize_module_line_endings
+from .admission_control import admission
+from .version_index import version_index
+from .search_index import search_index
+from .download_stats import download_stats, TRENDING_DAYS
+from .reverse_dependencies import reverse_dependency_index
+from .file_manifest import manifest_cache
+from .change_feed import record_change
+from .archive_utils import version_digest
+from .response_cache import response_cache
+from .module_trash import module_reaper
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
 templates = Jinja2Templates(directory="templates")
 
 BASE_DIR = "c_cpp_modules"
 
+# Public URL of the site, e.g. "https://cul.example.com". When set, cached pages link to it instead of the Host header of
+# whichever request rendered them first
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL")
+
 temp_link_code_map = {}
 
-def handle_remove_readonly(func, path, exc_info):
+# module name -> [lock, number of holders and waiters], see module_lock
+_module_locks: dict[str, list] = {}
+
+
+@asynccontextmanager
+async def module_lock(module_name: str):
+    '''
+    Serializes changes to the folder of a module, e.g. an update from the Web UI and a refresh triggered by a push.
+    The lock of a module is dropped once nobody holds or waits for it.
+
+    Args:
+        module_name (str): The name of the module.
+
+    Returns:
+        AsyncContextManager: Holds the lock of the module while the block runs.
+
+    Raises:
+        None
+    '''
+    entry = _module_locks.setdefault(module_name, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _module_locks[module_name]
+
+
+def with_public_base_url(request: Request) -> Request:
+    '''
+    Returns the request with its base URL replaced by PUBLIC_BASE_URL, so URLs generated from it (url_for in templates)
+    do not depend on the Host header. Returns the request unchanged if PUBLIC_BASE_URL is not set.
+
+    Args:
+        request (Request): The request object.
+
+    Returns:
+        Request: A request sharing the scope (and session) of the original one, with the configured base URL.
+
+    Raises:
+        None
+    '''
+    if not PUBLIC_BASE_URL:
+        return request
+    url = urlsplit(PUBLIC_BASE_URL)
+    root_path = url.path.rstrip("/")
+    headers = [(name, value) for name, value in request.scope["headers"] if name != b"host"]
+    headers.append((b"host", url.netloc.encode("latin-1")))
+    return Request({**request.scope, "scheme": url.scheme, "headers": headers, "root_path": root_path, "app_root_path": root_path})
+
+
+def normalize_repo_url(url: str) -> str:
+    '''
+    Normalizes a repository URL or path for comparison, so "https://github.com/a/b.git/" matches "https://github.com/a/b".
+    Stored as module_url_normalized on every module, so modules can be looked up by repository with an indexed query.
+    '''
+    return url.strip().rstrip("/").removesuffix(".git").removeprefix("file://").lower()
+
+async def refresh_module_indexes(module_name: str) -> None:
+    '''
+    Updates the in-memory indexes after a module has been uploaded or updated.
+
+    Args:
+        module_name (str): The name of the module.
+
+    Returns:
+        None
+
+    Raises:
+        None
     '''
-    This function removes the read-only attribute from a file or directory and then calls the provided function.
+    version_index.refresh_module(module_name)
+    search_index.refresh_module(module_name)
+    response_cache.invalidate_module(module_name)
+    await reverse_dependency_index.refresh_module(module_name)
+
+
+async def drop_module_indexes(module_name: str) -> None:
+    '''
+    Removes a deleted module from the in-memory indexes.
 
     Args:
-        func (function): The function to call.
-        path (str): The path to the file or directory.
-        exc_info (tuple): The exception information.
+        module_name (str): The name of the module.
 
     Returns:
         None
@@ -37,9 +134,31 @@ def handle_remove_readonly(func, path, exc_info):
     Raises:
         None
     '''
-    import stat
-    os.chmod(path, stat.S_IWRITE)
-    func(path)
+    version_index.remove_module(module_name)
+    search_index.remove_module(module_name)
+    manifest_cache.invalidate(module_name)
+    response_cache.invalidate_module(module_name)
+    await reverse_dependency_index.remove_module(module_name)
+
+async def get_download_summary() -> dict:
+    '''
+    Returns the popular and trending modules shown on the main page. Errors are logged and result in empty lists,
+    so that the page still renders when the stats cannot be read.
+
+    Args:
+        None
+
+    Returns:
+        dict: The popular and trending modules with their download counts, and the trending window in days.
+
+    Raises:
+        None
+    '''
+    try:
+        return {"popular": await download_stats.popular_modules(5), "trending": await download_stats.trending_modules(5), "trending_days": TRENDING_DAYS}
+    except Exception:
+        logger.exception("Error reading download stats")
+        return {"popular": [], "trending": [], "trending_days": TRENDING_DAYS}
 
 @router.get("/", response_class=HTMLResponse)
 async def login_page(request: Request):
@@ -193,7 +312,7 @@ async def main_page_webui(request: Request):
     if not request.session.get("email"):
         return RedirectResponse(url="/", status_code=303)
     
-    return templates.TemplateResponse("main_page.html", {"request": request})
+    return templates.TemplateResponse("main_page.html", {"request": request, "download_summary": await get_download_summary()})
 
 
 @router.post("/main_page", response_class=HTMLResponse)
@@ -225,17 +344,17 @@ async def main_page_search(request: Request, module_name: str = Form(...)):
 
     if matched_modules:
         for module_name in matched_modules:
-            versions_json = os.path.join(BASE_DIR, module_name, 'versions.json')
-            if os.path.exists(versions_json):
-                with open(versions_json, 'r') as file:
-                    module_versions = json.load(file)
-                    module_versions_dict[module_name] = [item['version'] for item in module_versions.get('versions', [])]
+            await version_index.load(module_name)
+            sorted_versions = version_index.sorted_versions(module_name)
+            if sorted_versions is not None:
+                # Newest version first
+                module_versions_dict[module_name] = sorted_versions[::-1]
             else:
                 error = "Some modules were found, but versions could not be loaded."
-        return templates.TemplateResponse("main_page.html", {"request": request, "module_versions": module_versions_dict, "error": error})
+        return templates.TemplateResponse("main_page.html", {"request": request, "module_versions": module_versions_dict, "error": error, "download_summary": await get_download_summary()})
     else:
         error = "No matching modules found."
-        return templates.TemplateResponse("main_page.html", {"request": request, "error": error})
+        return templates.TemplateResponse("main_page.html", {"request": request, "error": error, "download_summary": await get_download_summary()})
 
 
 @router.get("/upload_modules", response_class=HTMLResponse)
@@ -282,7 +401,7 @@ async def generate_code(data: dict):
     temp_link_code_map[github_repo_link] = code
     return {"generated_code": code}
 
-@router.post("/upload_modules", response_class=HTMLResponse)
+@router.post("/upload_modules", response_class=HTMLResponse, dependencies=[Depends(admission("ingest"))])
 async def upload_modules_webui(request: Request, github_repo_link: str = Form(...), db: AsyncIOMotorDatabase = Depends(get_database)):
     '''
     This function handles the upload of a CUL module via the Web UI. It verifies that the user is logged in, ensures the module does not already exist,
@@ -319,15 +438,12 @@ async def upload_modules_webui(request: Request, github_repo_link: str = Form(..
 
     expected_code = temp_link_code_map[github_repo_link]
 
-    cloned_status = os.system(f"git clone {github_repo_link} {module_folder}")
+    cloned_status = await run_in_threadpool(os.system, f"git clone {github_repo_link} {module_folder}")
     if cloned_status != 0:
         return templates.TemplateResponse("upload_modules.html", {"request": request, "error": "Error cloning the repository"})
     
     # Normalize line endings in the cloned files
-    for root, dirs, files in os.walk(module_folder):
-        for file in files:
-            file_path = os.path.join(root, file)
-            normalize_line_endings(file_path)
+    await run_in_threadpool(normalize_module_line_endings, module_folder)
 
     try:
         if not os.path.exists(os.path.join(module_folder, "versions.json")):
@@ -343,7 +459,7 @@ async def upload_modules_webui(request: Request, github_repo_link: str = Form(..
         if user_code != expected_code:
             raise Exception("Verification code mismatch")
 
-        hash_success_status = generate_module_checksum(module_folder)
+        hash_success_status = await run_in_threadpool(generate_module_checksum, module_folder)
         if not hash_success_status:
             raise Exception("Error generating checksum")
 
@@ -352,18 +468,26 @@ async def upload_modules_webui(request: Request, github_repo_link: str = Form(..
             "module_id": module_id,
             "module_name": module_name,
             "module_url": github_repo_link,
+            "module_url_normalized": normalize_repo_url(github_repo_link),
             "associated_user": request.session.get("email")
         }
         await db["modules"].insert_one(module_doc)
 
         del temp_link_code_map[github_repo_link]
 
-        return RedirectResponse(url="/main_page", status_code=303)
-
     except Exception as e:
-        shutil.rmtree(module_folder, onexc=handle_remove_readonly)
+        module_reaper.tombstone(module_folder)
         return templates.TemplateResponse("upload_modules.html", {"request": request, "error": str(e)})
 
+    # The module is stored from here on, failing to index it must neither delete its folder nor hide it from mirrors
+    try:
+        await refresh_module_indexes(module_name)
+    except Exception:
+        logger.exception("Error indexing uploaded module", extra={"module_name": module_name})
+    await record_change("upload", module_name, github_repo_link)
+
+    return RedirectResponse(url="/main_page", status_code=303)
+
 
 @router.get("/delete_module/{module_id}", response_class=HTMLResponse)
 async def delete_module_webui(request: Request, module_id: int, db: AsyncIOMotorDatabase = Depends(get_database)):
@@ -397,16 +521,21 @@ async def delete_module_webui(request: Request, module_id: int, db: AsyncIOMotor
     
     module_path = os.path.join(BASE_DIR, module['module_name'])
     if os.path.exists(module_path):
-        shutil.rmtree(module_path, onexc=handle_remove_readonly)
+        module_reaper.tombstone(module_path)
         delete_result = await db["modules"].delete_one({"module_id": module_id})
-        print(f"Deleted {delete_result.deleted_count} document")
+        try:
+            await drop_module_indexes(module['module_name'])
+        except Exception:
+            logger.exception("Error removing deleted module from the indexes", extra={"module_name": module["module_name"]})
+        await record_change("delete", module['module_name'], module.get('module_url'))
+        logger.info("Deleted module", extra={"module_name": module["module_name"], "deleted_count": delete_result.deleted_count})
     
     profile = await db["users"].find_one({"email": request.session.get("email")})
     modules = await db["modules"].find({"associated_user": request.session.get("email")}).to_list(100)
     return templates.TemplateResponse("profile.html", {"request": request, "profile": profile, "modules": modules})
 
 
-@router.get("/update_module/{module_id}", response_class=HTMLResponse)
+@router.get("/update_module/{module_id}", response_class=HTMLResponse, dependencies=[Depends(admission("ingest"))])
 async def update_module_webui(request: Request, module_id: int, db: AsyncIOMotorDatabase = Depends(get_database)):
     '''
     This function updates the module by pulling the latest changes from the github repository.
@@ -437,9 +566,15 @@ async def update_module_webui(request: Request, module_id: int, db: AsyncIOMotor
     if not module:
         return templates.TemplateResponse("profile.html", {"request": request, "error": "Module not found"})
     
-    os.system(f"cd {os.path.join(BASE_DIR, module['module_name'])} && git pull")
-    module_path = os.path.join(BASE_DIR, module['module_name'])
-    generate_checksums_for_new_versions(module_path)
+    async with module_lock(module['module_name']):
+        await run_in_threadpool(os.system, f"cd {os.path.join(BASE_DIR, module['module_name'])} && git pull")
+        module_path = os.path.join(BASE_DIR, module['module_name'])
+        await run_in_threadpool(generate_checksums_for_new_versions, module_path)
+        try:
+            await refresh_module_indexes(module['module_name'])
+        except Exception:
+            logger.exception("Error indexing updated module", extra={"module_name": module["module_name"]})
+    await record_change("update", module['module_name'], module.get('module_url'))
     
     profile = await db["users"].find_one({"email": request.session.get("email")})
     modules = await db["modules"].find({"associated_user": request.session.get("email")}).to_list(100)
@@ -470,20 +605,34 @@ async def get_module_info_webui(request: Request, module: str, version: str):
     module_info_file_path = os.path.join(BASE_DIR, module, version, 'module_info.json')
     if not os.path.exists(module_info_file_path):
         return HTMLResponse(content="<h1>Error 404: Module/Version not found.</h1>", status_code=404)
-    
-    with open(module_info_file_path, 'r') as file:
-        module_info = json.load(file)
-    
-    deps = module_info.get('requires', [])
-    data = {
-        "ModuleName": module,
-        "Version": version,
-        "Author": module_info.get('author'),
-        "Description": module_info.get('description'),
-        "License": module_info.get('license'),
-        "Dependencies": {dep.split('==')[0]: dep.split('==')[1] for dep in deps} if deps else None,
-    }
-    return templates.TemplateResponse("version_info.html", {"request": request, "data": data})
+
+    try:
+        dependents = await reverse_dependency_index.dependents(module, version)
+    except Exception:
+        logger.exception("Error reading dependents", extra={"module_name": module, "version": version})
+        dependents = None
+
+    async def render():
+        with open(module_info_file_path, 'r') as file:
+            module_info = json.load(file)
+
+        deps = module_info.get('requires', [])
+        data = {
+            "ModuleName": module,
+            "Version": version,
+            "Author": module_info.get('author'),
+            "Description": module_info.get('description'),
+            "License": module_info.get('license'),
+            "Dependencies": {dep.split('==')[0]: dep.split('==')[1] for dep in deps} if deps else None,
+            "Dependents": dependents,
+        }
+        return templates.TemplateResponse("version_info.html", {"request": with_public_base_url(request), "data": data})
+
+    # The page only changes with the content of the version and its dependents. The static links are rendered from
+    # PUBLIC_BASE_URL when it is set, so the key does not depend on client supplied headers
+    digest = await run_in_threadpool(version_digest, os.path.join(BASE_DIR, module, version))
+    dependents_digest = hashlib.sha256(json.dumps(dependents).encode()).hexdigest()
+    return await response_cache.get_or_compute("info", module, (request.url.path, PUBLIC_BASE_URL or ""), f"{digest}:{dependents_digest}", render)
 
 
 @router.get("/profile", response_class=HTMLResponse)
@@ -508,7 +657,12 @@ async def get_profile_webui(request: Request, db: AsyncIOMotorDatabase = Depends
 
     profile = await db["users"].find_one({"email": request.session.get("email")})
     modules = await db["modules"].find({"associated_user": request.session.get("email")}).to_list(100)
-    return templates.TemplateResponse("profile.html", {"request": request, "profile": profile, "modules": modules})
+    try:
+        downloads = await download_stats.module_totals([module["module_name"] for module in modules])
+    except Exception:
+        logger.exception("Error reading download stats")
+        downloads = None
+    return templates.TemplateResponse("profile.html", {"request": request, "profile": profile, "modules": modules, "downloads": downloads})
 
 
 @router.get("/logout", response_class=RedirectResponse)